@@ -0,0 +1,112 @@
+import multiprocessing
+import os
+import signal
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from PIL import Image
+from loguru import logger
+from settings import allow_large_images
+import encoders
+import timing
+import watermark
+
+# Parallel export over a process pool. At most `max_in_flight` jobs are queued
+# at once so only that many decoded frames can be alive, whatever the batch size.
+
+
+def plain_config(config):
+    # ez.Config -> dict, cheaper to pickle to every worker
+    return config.dict() if hasattr(config, 'dict') else config
+
+
+def resolve_workers(workers=0, max_in_flight=0):
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 2
+    return workers, max(max_in_flight, workers)
+
+
+def probe_sizes(jobs, limit=1):
+    # geometry of the first images, so workers pre-size fonts and icons for it
+    sizes = []
+    for src, _ in jobs[:limit]:
+        try:
+            sizes.append(Image.open(src).size)
+        except OSError:
+            pass
+    return sizes
+
+
+def init_worker(config, img_sizes, trace):
+    allow_large_images()
+    watermark.warm_resources(config, img_sizes)
+    # after warming, so the spans are those of the jobs only
+    timing.enable(trace)
+
+
+def init_daemon_worker(config, img_sizes, trace):
+    # long running services: Ctrl-C goes to the whole process group and the
+    # parent finishes the images in flight itself, workers must not die under it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker(config, img_sizes, trace)
+
+
+def worker_stats():
+    return timing.drain(), encoders.drain()
+
+
+def render_job(src, dst, config):
+    # spans and encoder counters recorded in a worker process travel back with the result
+    try:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        watermark.process_single(src, config, dst)
+        return src, dst, None, worker_stats()
+    except Exception as e:
+        return src, dst, f"{type(e).__name__}: {e}", worker_stats()
+
+
+def run_batch(jobs, config, workers=0, max_in_flight=0, progress=None, on_success=None):
+    """Export (src, dst) jobs and return the list of (src, error) failures.
+
+    `progress(done, total)` is called from the calling thread after every job,
+    `on_success(src, dst)` after every job that was written.
+    """
+    jobs = list(jobs)
+    total = len(jobs)
+    config = plain_config(config)
+    workers, max_in_flight = resolve_workers(workers, max_in_flight)
+    failed = []
+    done = 0
+
+    def finish(result):
+        nonlocal done
+        src, dst, error, (spans, encoded) = result
+        timing.merge(spans)
+        encoders.merge(encoded)
+        done += 1
+        if error:
+            logger.error(f"{src}: {error}")
+            failed.append((src, error))
+        elif on_success:
+            on_success(src, dst)
+        if progress:
+            progress(done, total)
+
+    if workers == 1 or total <= 1:
+        for src, dst in jobs:
+            finish(render_job(src, dst, config))
+        return failed
+
+    logger.info(f"batch: {total} images, {workers} workers, {max_in_flight} in flight")
+    # spawn: never fork a process that may be running Qt threads
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=init_worker,
+                             initargs=(config, probe_sizes(jobs), timing.enabled)) as pool:
+        pending = set()
+        for src, dst in jobs:
+            if len(pending) >= max_in_flight:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(future.result())
+            pending.add(pool.submit(render_job, src, dst, config))
+        for future in wait(pending).done:
+            finish(future.result())
+    return failed
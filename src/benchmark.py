@@ -0,0 +1,279 @@
+import argparse
+import io
+import json
+import math
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from PIL import Image, ImageChops, ImageOps
+import piexif
+from loguru import logger
+from settings import CONFIG_PATH, TEMP_PATH, allow_large_images, load_config
+from exif import get_image_info
+from timing import percentile
+import encoders
+import watermark
+
+# Offline benchmark of the rendering hot path on a synthetic corpus.
+#   python benchmark.py -c config.yaml --sizes 12,24,60 --save baseline.json
+#   python benchmark.py -c config.yaml --sizes 12,24,60 --compare baseline.json
+
+BENCH_PATH = TEMP_PATH / "bench"
+STAGES = ('exif', 'decode', 'render', 'encode', 'total')
+# what a regression is measured on, per stage
+COMPARED = ('p50_ms', 'p95_ms', 'peak_rss_mb')
+
+# cold start in a fresh interpreter, p50 in ms: up to the intro window being
+# shown for the GUI, up to argument parsing for the headless CLI
+# {config}: a scratch copy, the intro window writes its config back
+STARTUP = {
+    'gui': ("import sys; from PyQt5.QtWidgets import QApplication; from gui import IntroWindow; "
+            "app = QApplication(sys.argv); window = IntroWindow({config!r}); window.show(); app.processEvents()"),
+    'cli': "import cli; cli.parse_args(['.'])",
+}
+# defaults for --gui-target / --cli-target, measured on a desktop; slower machines pass their own
+STARTUP_TARGET_MS = {'gui': 250, 'cli': 200}
+
+BENCH_EXIF = {
+    '0th': {
+        271: b"LEICA CAMERA AG",
+        272: b"LEICA M11",
+        274: 1,
+        282: (300, 1),
+        283: (300, 1),
+        296: 2,
+        305: b"LEICA M11 2.0.1",
+        306: b"2023:05:01 12:34:56",
+    },
+    'Exif': {
+        42036: b"SUMMILUX-M 1:1.4/35 ASPH.",
+        37386: (35, 1),
+        33437: (14, 10),
+        33434: (1, 250),
+        34855: 64,
+        34850: 3,
+        37380: (0, 1),
+        37383: 5,
+        36867: b"2023:05:01 12:34:56",
+        36868: b"2023:05:01 12:34:56",
+        41987: 0,
+    },
+    'GPS': {
+        1: b"N",
+        2: ((48, 1), (51, 1), (2400, 100)),
+        3: b"E",
+        4: ((2, 1), (21, 1), (700, 100)),
+    },
+}
+
+
+def synthetic_size(megapixels, portrait=False):
+    # 3:2 frame, the common sensor ratio
+    width = int(math.sqrt(megapixels * 1e6 * 3 / 2))
+    height = int(width * 2 / 3)
+    return (height, width) if portrait else (width, height)
+
+
+def make_image(size):
+    # deterministic and photo-like enough for the JPEG codec: fractal texture
+    # over colour gradients plus sensor-like grain, so files land near the
+    # size of real camera JPEGs and the entropy coder has real work to do
+    texture = Image.effect_mandelbrot((1024, 1024), (-0.75, -0.2, -0.65, -0.1), 256)
+    texture = ImageOps.autocontrast(texture).resize(size, Image.BILINEAR)
+    grain = Image.new('L', size)
+    tile = Image.effect_noise((256, 256), 12)
+    for x in range(0, size[0], 256):
+        for y in range(0, size[1], 256):
+            grain.paste(tile, (x, y))
+    texture = ImageChops.add(texture, grain, 1, -128)
+    red = Image.linear_gradient('L').resize(size)
+    blue = Image.linear_gradient('L').rotate(90).resize(size)
+    return Image.merge('RGB', (ImageChops.add(red, texture, 2), texture, ImageChops.add(blue, texture, 2)))
+
+
+def make_exif(img):
+    thumb = img.copy()
+    thumb.thumbnail((160, 160))
+    data = io.BytesIO()
+    thumb.save(data, 'JPEG', quality=75)
+    return piexif.dump(dict(BENCH_EXIF, **{'1st': {}, 'thumbnail': data.getvalue()}))
+
+
+def make_corpus(folder, sizes, quality=92):
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for megapixels in sizes:
+        for portrait in (False, True):
+            name = f"{megapixels}mp_{'portrait' if portrait else 'landscape'}.jpg"
+            path = os.path.join(folder, name)
+            if not os.path.exists(path):
+                logger.info(f"generating {name}")
+                img = make_image(synthetic_size(megapixels, portrait))
+                img.save(path, 'JPEG', quality=quality, exif=make_exif(img))
+            paths.append(path)
+    return paths
+
+
+def reset_peak_rss():
+    # Linux: "5" resets VmHWM to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss never goes down, so without /proc this is the process peak so far
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_image(path, config, repeat):
+    timings = {stage: [] for stage in STAGES}
+    peaks = {stage: 0.0 for stage in STAGES}
+
+    def measure(stage, func):
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = func()
+        timings[stage].append(time.perf_counter() - start)
+        peak = peak_rss_mb()
+        peaks[stage] = max(peaks[stage], peak)
+        # each stage resets VmHWM, the image's peak is the highest stage peak
+        peaks['total'] = max(peaks['total'], peak)
+        return result
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        info = measure('exif', lambda: get_image_info(path))
+        canvas, layout = measure('decode', lambda: watermark.open_canvas(path, config))
+        measure('render', lambda: watermark.draw_strip(canvas, info, layout, config))
+        measure('encode', lambda: encoders.save(canvas, io.BytesIO(), config['output']))
+        timings['total'].append(time.perf_counter() - start)
+        del canvas
+
+    return {
+        stage: {
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'images_per_second': round(len(values) / sum(values), 2),
+            'peak_rss_mb': round(peaks[stage], 1),
+        }
+        for stage, values in timings.items()
+    }
+
+
+def run(paths, config, repeat):
+    results = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        # warm fonts, icons and the layout plan, they are a per-process cost
+        canvas, layout = watermark.open_canvas(path, config)
+        watermark.draw_strip(canvas, get_image_info(path), layout, config)
+        del canvas
+        results[name] = bench_image(path, config, repeat)
+        total = results[name]['total']
+        logger.info(f"{name}: {total['images_per_second']} img/s, p50 {total['p50_ms']}ms, p95 {total['p95_ms']}ms, peak {total['peak_rss_mb']}MB")
+    return results
+
+
+def startup(repeat, config_path, targets=STARTUP_TARGET_MS):
+    # offscreen, so the numbers do not depend on the window manager
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        # the user's config, or the template when there is none, never written to
+        config = os.path.join(scratch, "config.yaml")
+        if os.path.exists(config_path):
+            shutil.copy(config_path, config)
+        for name, code in STARTUP.items():
+            code = code.format(config=config)
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), env=env, check=True)
+                times.append(time.perf_counter() - start)
+            results[name] = {
+                'p50_ms': round(percentile(times, 50) * 1000, 1),
+                'p95_ms': round(percentile(times, 95) * 1000, 1),
+                'target_ms': targets[name],
+            }
+            logger.info(f"{name} cold start: p50 {results[name]['p50_ms']}ms, p95 {results[name]['p95_ms']}ms, target {targets[name]}ms")
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, stages in results.items():
+        for stage, metrics in stages.items():
+            base = baseline.get(name, {}).get(stage)
+            if not base:
+                continue
+            for metric in COMPARED:
+                if not base.get(metric):
+                    continue
+                change = metrics[metric] / base[metric] - 1
+                line = f"{name:>20} {stage:>7} {metric:>12}: {base[metric]:>9} -> {metrics[metric]:>9} ({change:+.1%})"
+                print(line)
+                if change > threshold:
+                    regressions.append(line)
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark exif / decode / render / encode on a synthetic corpus")
+    parser.add_argument("-c", "--config", default=str(CONFIG_PATH), help="config yaml (fonts must exist)")
+    parser.add_argument("--sizes", default="12,24,45,60,100", help="megapixels, comma separated")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per image")
+    parser.add_argument("--corpus", default=str(BENCH_PATH), help="where synthetic images are generated and reused")
+    parser.add_argument("--save", help="write results as json, e.g. a new baseline")
+    parser.add_argument("--compare", help="baseline json to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown / growth before failing")
+    parser.add_argument("--startup", action="store_true", help="measure GUI and CLI cold start against their targets instead")
+    parser.add_argument("--gui-target", type=float, default=STARTUP_TARGET_MS['gui'], help="--startup: GUI cold start target in ms")
+    parser.add_argument("--cli-target", type=float, default=STARTUP_TARGET_MS['cli'], help="--startup: CLI cold start target in ms")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    allow_large_images()
+    # the hot path logs per image; keep the numbers readable
+    logger.remove()
+    logger.add(sys.stderr, level="INFO", filter=lambda record: record["name"] == __name__)
+    if args.startup:
+        results = startup(args.repeat, args.config, {'gui': args.gui_target, 'cli': args.cli_target})
+        print(json.dumps(results, indent=2))
+        return 1 if any(result['p50_ms'] > result['target_ms'] for result in results.values()) else 0
+
+    config = load_config(args.config).dict()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = run(make_corpus(args.corpus, sizes), config, args.repeat)
+    print(json.dumps(results, indent=2))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+import argparse
+import os
+import sys
+from loguru import logger
+from settings import CONFIG_PATH, allow_large_images, load_config
+from batch import run_batch
+from pipeline import Pipeline
+from manifest import ExportManifest
+from scan import ScanFilter, file_matches, scan_files
+import encoders
+import timing
+
+# headless batch entry point, no QApplication is created
+#   python cli.py ~/Photos/2023 -o ~/Photos/export
+
+
+def collect_jobs(inputs, output=None, recursive=True, scan_filter=None):
+    # (source, destination) pairs; directory trees are mirrored below the output,
+    # several of them into one output each below a sub folder named like it
+    jobs = []
+    per_folder = output and sum(os.path.isdir(path) for path in inputs) > 1
+    for path in inputs:
+        path = os.path.abspath(path)
+        if os.path.isfile(path):
+            if not file_matches(path, scan_filter):
+                continue
+            out_dir = output or os.path.join(os.path.dirname(path), "export")
+            jobs.append((path, os.path.join(out_dir, os.path.basename(path))))
+            continue
+
+        if per_folder:
+            out_root = os.path.abspath(os.path.join(output, os.path.basename(path)))
+        else:
+            out_root = os.path.abspath(output or os.path.join(path, "export"))
+        # never re-watermark our own exports
+        for found in scan_files([path], scan_filter, recursive, skip=[output or out_root]):
+            rel = os.path.relpath(found.path, path)
+            jobs.append((found.path, os.path.normpath(os.path.join(out_root, rel))))
+    return jobs
+
+
+def clashes(jobs):
+    # destination -> sources, for destinations more than one job would write
+    sources = {}
+    for src, dst in jobs:
+        sources.setdefault(dst, []).append(src)
+    return {dst: srcs for dst, srcs in sources.items() if len(srcs) > 1}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Add LEICA style watermarks without the GUI")
+    parser.add_argument("inputs", nargs="+", help="image files or folders")
+    parser.add_argument("-o", "--output", help="export folder (default: <input>/export), several input folders go into sub folders named like them")
+    parser.add_argument("-c", "--config", default=str(CONFIG_PATH), help="config yaml")
+    parser.add_argument("--no-recursive", action="store_true", help="do not descend into sub folders")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: config batch.workers, 0 = all cores)")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="jobs queued at once, bounds memory (default: 2 per worker)")
+    parser.add_argument("--maker", help="only images whose EXIF camera maker contains this, e.g. leica")
+    parser.add_argument("--lens", help="only images whose EXIF lens contains this, e.g. summilux")
+    parser.add_argument("--since", help="only images taken on or after YYYY[-MM[-DD]]")
+    parser.add_argument("--until", help="only images taken on or before YYYY[-MM[-DD]], inclusive")
+    parser.add_argument("--force", action="store_true", help="re-export images even if the export manifest says they are current")
+    parser.add_argument("--pipeline", action="store_true", help="overlap decode, render and encode on threads instead of a process pool")
+    parser.add_argument("--readers", type=int, default=2, help="pipeline decode threads")
+    parser.add_argument("--compositors", type=int, default=0, help="pipeline render threads (default: one per core)")
+    parser.add_argument("--writers", type=int, default=None, help="pipeline encode threads (default: config batch.encode_threads)")
+    parser.add_argument("--format", choices=['source'] + sorted(encoders.ENCODERS), help="output format (default: config output.format)")
+    parser.add_argument("--timings", help="write per-span timings (count, total, p50, p95, max) as json")
+    parser.add_argument("--trace", help="write every span as a Chrome trace (chrome://tracing, Perfetto)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    allow_large_images()
+    timing.enable(bool(args.timings or args.trace))
+    config = load_config(args.config)
+    if args.format:
+        config['output']['format'] = args.format
+    try:
+        scan_filter = ScanFilter(args.maker, args.lens, args.since, args.until)
+    except ValueError as e:
+        logger.error(e)
+        return 2
+    jobs = collect_jobs(args.inputs, args.output, recursive=not args.no_recursive, scan_filter=scan_filter)
+    jobs = [(src, encoders.output_path(dst, config['output'])) for src, dst in jobs]
+    clashing = clashes(jobs)
+    if clashing:
+        # e.g. two inputs with the same name, or a.jpg and a.png into one format
+        for dst, sources in clashing.items():
+            logger.error(f"{dst} would be written by {', '.join(sources)}")
+        return 2
+    manifest = ExportManifest(config)
+    total = len(jobs)
+    pending = manifest.pending(jobs)
+    if not args.force:
+        jobs = pending
+    logger.info(f"{total} images, {len(jobs)} to process, {total - len(jobs)} up to date")
+
+    try:
+        if args.pipeline:
+            writers = args.writers if args.writers is not None else config['batch']['encode_threads']
+            pipeline = Pipeline(config, args.readers, args.compositors, writers)
+            failed = pipeline.run(jobs, on_success=manifest.record)
+            for stage, stats in pipeline.snapshot().items():
+                logger.info(f"{stage}: {stats}")
+        else:
+            workers = args.workers if args.workers is not None else config['batch']['workers']
+            max_in_flight = args.max_in_flight if args.max_in_flight is not None else config['batch']['max_in_flight']
+            failed = run_batch(jobs, config, workers, max_in_flight, on_success=manifest.record)
+    finally:
+        # whatever finished is kept, a re-run resumes from there
+        manifest.flush()
+        if args.timings:
+            timing.write_json(args.timings, timing.summary())
+        if args.trace:
+            timing.write_json(args.trace, timing.chrome_trace())
+    for name, stats in encoders.summary().items():
+        logger.info(f"encoder {name}: {stats}")
+    logger.info(f"done, {len(jobs) - len(failed)} exported, {len(failed)} failed")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import mmap
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from PIL import Image
+from loguru import logger
+from settings import TEMP_PATH
+
+# Canvases for panoramas and scans too large to hold on the heap. The pixels
+# live in a memory-mapped, already unlinked temp file; while the decoder or
+# the encoder sweeps through the rows, `trimming` keeps handing the touched
+# pages back to the kernel, so resident memory stays at a few bands of rows
+# whatever the image size. Costs 4 bytes of temp disk space per pixel.
+
+CANVAS_PATH = TEMP_PATH / "canvas"
+
+
+def attach(img, size, folder=CANVAS_PATH):
+    """Back img with a disk mapped RGB frame of `size`, for load() to decode into."""
+    os.makedirs(folder, exist_ok=True)
+    # Pillow keeps RGB as 4 bytes per pixel
+    nbytes = size[0] * size[1] * 4
+    with tempfile.TemporaryFile(dir=folder) as f:
+        f.truncate(nbytes)
+        mapping = mmap.mmap(f.fileno(), nbytes)
+    try:
+        img.im = Image.core.map_buffer(mapping, size, 'raw', 0, ('RGB', 0, 1))
+    except (AttributeError, TypeError, ValueError) as e:
+        # map_buffer is Pillow's core API (tested with 12.x); without it the
+        # canvas stays on the heap, the render still works with more memory
+        logger.warning(f"no disk canvas ({type(e).__name__}: {e}), rendering in memory")
+        mapping.close()
+        return img
+    # lives exactly as long as the image; copies of it are ordinary heap images
+    img.disk_mapping = mapping
+    return img
+
+
+def trim(img):
+    # shared file mapping: dropped pages keep their content in the page cache
+    # and on disk, the next access faults them back in
+    mapping = getattr(img, 'disk_mapping', None)
+    if mapping is not None and hasattr(mapping, 'madvise'):
+        mapping.madvise(mmap.MADV_DONTNEED)
+
+
+@contextmanager
+def trimming(img, interval=0.05):
+    """Trim img every `interval` seconds while a decoder or encoder runs on it.
+
+    A no-op for ordinary heap images. Pillow's codecs release the GIL, so
+    the trimming thread gets to run while rows are being streamed.
+    """
+    if getattr(img, 'disk_mapping', None) is None:
+        yield
+        return
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            trim(img)
+
+    thread = threading.Thread(target=run, name="canvas-trim", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        trim(img)
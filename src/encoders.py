@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+import piexif
+
+# Output encoders. Each one writes an RGB image to a path or file object with
+# the options from its section of the `output` config, plus the source's EXIF
+# and ICC profile when those are kept. `output.format: source` picks the
+# encoder from the export's extension, which is the source's.
+#   @register('avif', '.avif')
+#   def save_avif(img, fp, options, exif, icc): ...
+
+ENCODERS = {}
+SUFFIXES = {}
+SUFFIX_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.webp': 'webp'}
+# image mode -> the colour space field of an ICC profile header that fits it
+ICC_SPACES = {'RGB': b'RGB ', 'RGBA': b'RGB ', 'L': b'GRAY', 'CMYK': b'CMYK'}
+
+# name -> [images, seconds, bytes], for this process; workers drain() theirs
+# back to the parent like the timing spans
+stats = {}
+stats_lock = threading.Lock()
+
+
+def register(name, suffix):
+    def add(func):
+        ENCODERS[name] = func
+        SUFFIXES[name] = suffix
+        return func
+    return add
+
+
+@register('jpeg', '.jpg')
+def save_jpeg(img, fp, options, exif, icc):
+    img.save(fp, 'JPEG', quality=options['quality'], subsampling=options['subsampling'],
+             optimize=options['optimize'], progressive=options['progressive'], exif=exif, icc_profile=icc)
+
+
+@register('webp', '.webp')
+def save_webp(img, fp, options, exif, icc):
+    img.save(fp, 'WEBP', quality=options['quality'], method=options['method'],
+             lossless=options['lossless'], exif=exif, icc_profile=icc)
+
+
+@register('png', '.png')
+def save_png(img, fp, options, exif, icc):
+    img.save(fp, 'PNG', compress_level=options['compress_level'], exif=exif, icc_profile=icc)
+
+
+@register('preview', '.jpg')
+def save_preview(img, fp, options, exif, icc):
+    # screen-grade: chroma subsampled, single pass Huffman tables, no metadata
+    img.save(fp, 'JPEG', quality=options['quality'], subsampling='4:2:0')
+
+
+def encoder_for(out_path, output):
+    if output['format'] != 'source':
+        return output['format']
+    suffix = os.path.splitext(out_path)[1].lower() if isinstance(out_path, str) else ''
+    return SUFFIX_FORMATS.get(suffix, 'jpeg')
+
+
+def output_path(path, output):
+    """The export path for `path` once the configured format's extension is applied."""
+    if output['format'] == 'source':
+        return path
+    root, suffix = os.path.splitext(path)
+    # keep .jpeg / .JPG spellings of the same format
+    if SUFFIX_FORMATS.get(suffix.lower()) == output['format']:
+        return path
+    return root + SUFFIXES[output['format']]
+
+
+def passthrough_exif(raw, size):
+    # the frame and strip are composed around the pixels as stored, which is how
+    # every export looked before EXIF was kept: Orientation 1 keeps viewers from
+    # rotating the strip off the bottom. Update the dimensions to the canvas and
+    # drop the embedded thumbnail, which shows no watermark
+    try:
+        exif = piexif.load(raw)
+        exif['0th'][piexif.ImageIFD.Orientation] = 1
+        if exif['Exif']:
+            exif['Exif'][piexif.ExifIFD.PixelXDimension] = size[0]
+            exif['Exif'][piexif.ExifIFD.PixelYDimension] = size[1]
+        exif['1st'] = {}
+        exif['thumbnail'] = None
+        return piexif.dump(exif)
+    except Exception:
+        # tags piexif cannot write back; better no EXIF than a broken file
+        return b''
+
+
+def save(img, fp, output):
+    """Encode img with the configured encoder, return the number of bytes written.
+
+    `fp` is a path or a binary file object. Source EXIF and ICC are read from
+    img.info, where open_canvas leaves them.
+    """
+    name = encoder_for(fp, output)
+    exif = passthrough_exif(img.info['exif'], img.size) if output['keep_exif'] and img.info.get('exif') else b''
+    icc = img.info.get('icc_profile') if output['keep_icc'] else None
+    if icc and icc[16:20] != ICC_SPACES.get(img.mode):
+        # a profile for another colour space would make viewers misread the pixels
+        icc = None
+    start = time.perf_counter()
+    ENCODERS[name](img, fp, output.get(name, {}), exif, icc)
+    seconds = time.perf_counter() - start
+    nbytes = os.path.getsize(fp) if isinstance(fp, str) else fp.tell()
+    record(name, seconds, nbytes)
+    return nbytes
+
+
+def record(name, seconds, nbytes):
+    with stats_lock:
+        entry = stats.setdefault(name, [0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += nbytes
+
+
+def drain():
+    global stats
+    with stats_lock:
+        drained, stats = stats, {}
+    return drained
+
+
+def merge(drained):
+    with stats_lock:
+        for name, (images, seconds, nbytes) in drained.items():
+            entry = stats.setdefault(name, [0, 0.0, 0])
+            entry[0] += images
+            entry[1] += seconds
+            entry[2] += nbytes
+
+
+def summary():
+    # per encoder thread time, so images_per_second is what one thread sustains
+    with stats_lock:
+        return {
+            name: {
+                'images': images,
+                'seconds': round(seconds, 3),
+                'images_per_second': round(images / seconds, 2) if seconds else 0.0,
+                'mb_per_second': round(nbytes / 1e6 / seconds, 2) if seconds else 0.0,
+                'mean_kb': round(nbytes / 1e3 / images, 1) if images else 0.0,
+            }
+            for name, (images, seconds, nbytes) in sorted(stats.items())
+        }
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import threading
+from collections import OrderedDict
+from PIL import Image
+import piexif
+from settings import TEMP_PATH
+
+INDEX_PATH = TEMP_PATH / "index"
+
+# EXIF is read straight from the file header (JPEG APP1 / PNG eXIf) without
+# decoding pixels, and parsed results are kept in a per-folder SQLite index.
+
+
+def read_jpeg_exif(f):
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        # SOS / EOI: image data starts, no APP1 before it
+        if marker[1] in (0xda, 0xd9):
+            return None
+        if 0xd0 <= marker[1] <= 0xd7 or marker[1] == 0x01:
+            continue
+        header = f.read(2)
+        # truncated file, or a corrupt segment length
+        if len(header) < 2:
+            return None
+        length = struct.unpack('>H', header)[0]
+        if length < 2:
+            return None
+        if marker[1] == 0xe1:
+            data = f.read(length - 2)
+            if data.startswith(b'Exif\x00\x00'):
+                return data
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def read_png_exif(f):
+    if f.read(8) != b'\x89PNG\r\n\x1a\n':
+        return None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        length, chunk = struct.unpack('>I4s', header)
+        if chunk == b'eXIf':
+            return b'Exif\x00\x00' + f.read(length)
+        if chunk in (b'IDAT', b'IEND'):
+            return None
+        f.seek(length + 4, os.SEEK_CUR)
+
+
+def read_exif(img_path):
+    with open(img_path, 'rb') as f:
+        head = f.read(8)
+        f.seek(0)
+        if head.startswith(b'\xff\xd8'):
+            return read_jpeg_exif(f)
+        if head.startswith(b'\x89PNG'):
+            return read_png_exif(f)
+    # other formats: Pillow still only reads the header on open
+    return Image.open(img_path).info.get('exif')
+
+
+def get_shutter_speed(value):
+    if value < 1:
+        return f"1/{int(1/value)}s"
+    else:
+        return f"{int(value)}s"
+
+
+def info_from_exif(exif):
+    piexif_dict = piexif.load(exif)
+    target_dict = {
+        'camera': piexif_dict['0th'][272].decode('utf-8'),
+        'camera_maker': piexif_dict['0th'][271].decode('utf-8'),
+        'lens': piexif_dict['Exif'][42036].decode('utf-8'),
+        'focal_length': piexif_dict['Exif'][37386][0]/piexif_dict['Exif'][37386][1],
+        'aperture': piexif_dict['Exif'][33437][0]/piexif_dict['Exif'][33437][1],
+        'shutter_speed': piexif_dict['Exif'][33434][0]/piexif_dict['Exif'][33434][1],
+        'iso': piexif_dict['Exif'][34855],
+        'date': piexif_dict['Exif'][36867].decode('utf-8'),
+        'time': piexif_dict['Exif'][36868].decode('utf-8'),
+        'gps': piexif_dict['GPS']
+    }
+
+    target_dict['focal_length'] = f"{target_dict['focal_length']}mm"
+    target_dict['aperture'] = f"f/{target_dict['aperture']}"
+    target_dict['shutter_speed'] = get_shutter_speed(target_dict['shutter_speed'])
+    target_dict['iso'] = f"ISO {target_dict['iso']}"
+    target_dict['date'] = target_dict['date'].split(' ')[0].replace(':', '-')
+    target_dict['time'] = target_dict['time'].split(' ')[1]
+
+    return target_dict
+
+
+def get_image_info(img_path):
+    exif = read_exif(img_path)
+    if not exif:
+        raise KeyError('exif')
+    return info_from_exif(exif)
+
+
+def json_safe(value):
+    # piexif GPS values are bytes / tuples keyed by int tags
+    if isinstance(value, dict):
+        return {str(k): json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(v) for v in value]
+    if isinstance(value, bytes):
+        return value.decode('latin-1')
+    return value
+
+
+class ExifIndex:
+    """Parsed EXIF of one folder, invalidated per file by mtime and size."""
+
+    def __init__(self, folder, root=INDEX_PATH):
+        self.folder = os.path.abspath(folder)
+        os.makedirs(root, exist_ok=True)
+        name = hashlib.sha1(self.folder.encode('utf-8')).hexdigest()
+        self.db_path = os.path.join(root, name + ".sqlite")
+        self.lock = threading.Lock()
+        self.db = None
+        with self.lock:
+            self.connection()
+
+    def connection(self):
+        # under self.lock; a closed index reconnects when it is used again
+        if self.db is None:
+            self.db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "name TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, info TEXT)"
+            )
+            self.db.commit()
+        return self.db
+
+    def get(self, img_path):
+        name = os.path.basename(img_path)
+        st = os.stat(img_path)
+        with self.lock:
+            row = self.connection().execute("SELECT mtime_ns, size, info FROM images WHERE name = ?", (name,)).fetchone()
+        if row and row[0] == st.st_mtime_ns and row[1] == st.st_size:
+            info = json.loads(row[2])
+            if info is None:
+                # recorded by lookup(): no EXIF, or not the tags the strip needs
+                raise KeyError('exif')
+            return info
+
+        try:
+            info = json_safe(get_image_info(img_path))
+        except OSError:
+            raise
+        except Exception:
+            # unusable EXIF: remembered as null like lookup() does, so the
+            # next preview of this file does not parse it again
+            self.store(name, st, None)
+            raise
+        self.store(name, st, info)
+        return info
+
+    def store(self, name, st, info):
+        with self.lock:
+            self.connection().execute(
+                "INSERT OR REPLACE INTO images (name, mtime_ns, size, info) VALUES (?, ?, ?, ?)",
+                (name, st.st_mtime_ns, st.st_size, json.dumps(info)),
+            )
+            self.db.commit()
+
+    def lookup(self, entries):
+        """name -> info for os.DirEntry's of this folder, None where the EXIF is unusable.
+
+        One query for the whole folder; new and changed files are parsed and
+        written back in one transaction, unusable ones as null so the next
+        scan skips them as well.
+        """
+        with self.lock:
+            rows = {row[0]: row[1:] for row in self.connection().execute("SELECT name, mtime_ns, size, info FROM images")}
+        infos = {}
+        parsed = []
+        for entry in entries:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            row = rows.get(entry.name)
+            if row and row[0] == st.st_mtime_ns and row[1] == st.st_size:
+                infos[entry.name] = json.loads(row[2])
+                continue
+            try:
+                info = json_safe(get_image_info(entry.path))
+            except OSError:
+                # unreadable right now, e.g. still being copied; try again next time
+                continue
+            except Exception:
+                info = None
+            infos[entry.name] = info
+            parsed.append((entry.name, st.st_mtime_ns, st.st_size, json.dumps(info)))
+        if parsed:
+            with self.lock:
+                self.connection().executemany(
+                    "INSERT OR REPLACE INTO images (name, mtime_ns, size, info) VALUES (?, ?, ?, ?)", parsed)
+                self.db.commit()
+        return infos
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+# the folders used last, one connection each; a batch over a year/month/day
+# archive touches hundreds, each connection holds a few file descriptors
+MAX_OPEN_INDEXES = 16
+indexes = OrderedDict()
+indexes_lock = threading.Lock()
+
+
+def index_for(folder):
+    folder = os.path.abspath(folder)
+    with indexes_lock:
+        if folder in indexes:
+            indexes.move_to_end(folder)
+        else:
+            indexes[folder] = ExifIndex(folder)
+            if len(indexes) > MAX_OPEN_INDEXES:
+                # a thread still holding the evicted index reconnects on its next call
+                indexes.popitem(last=False)[1].close()
+        return indexes[folder]
+
+
+def cached_image_info(img_path):
+    return index_for(os.path.dirname(os.path.abspath(img_path))).get(img_path)
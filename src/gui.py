@@ -1,70 +1,199 @@
-from pathlib import Path
 import os
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
-from PyQt5.QtWidgets import *
-from PIL import Image, ImageDraw, ImageFont
+import threading
+from PyQt5.QtCore import QObject, QPoint, QRunnable, Qt, QThread, QThreadPool, QTimer, pyqtSignal
+from PyQt5.QtGui import QColor, QIcon, QImage, QPixmap
+from PyQt5.QtWidgets import (QAbstractItemView, QFileDialog, QFormLayout, QGridLayout, QHBoxLayout, QLabel,
+                             QLineEdit, QListView, QListWidget, QListWidgetItem, QMessageBox, QProgressBar,
+                             QPushButton, QScrollArea, QVBoxLayout, QWidget)
 from loguru import logger
-import piexif
-import ezkfg as ez
+from settings import CONFIG_PATH, PREVIEW_SIZE, TEMP_PATH, THUMB_SIZE, allow_large_images, load_config, save_config
+
+# The intro window only needs Qt and the config. Pillow, the renderer and the
+# batch machinery are imported where they are first used, once a folder is open.
 
-FONTS_PATH = Path(__file__).parent / "asset" / "fonts"
-ICONS_PATH = Path(__file__).parent / "asset" / "icons"
-TEMP_PATH = Path(__file__).parent / "temp"
 TEMP_PATH.mkdir(exist_ok=True)
 
-CONFIG_TEMPLATE = {
-    'folder_history': [],
-    'max_folder_history': 10,
-    'watermark': {
-        'text': 'LEICA',
-        'font': {
-            'bold': str(FONTS_PATH / "SourceHanSansCN-Bold.otf"),
-            'light': str(FONTS_PATH / "SourceHanSansCN-Light.otf"),
-        },
-        'font_size': "20%",
-        'font_color': [0, 0, 0, 255],
-        'border': {
-            "size": "3%",
-            "ratio": "auto",
-        },
-        'bg_color': [255, 255, 255, 255],
-        'text_area': {
-            'height': "15%",
-            'width': "100%",
-        },
-        'margin': '3%',
-        'div_line_width': 10,
-        'div_line_color': [156, 156, 156, 255],
-    },
-    'show_info': {
-        'camera': True,
-        'camera_maker': True,
-        'lens': True,
-        'focal_length': True,
-        'aperture': True,
-        'shutter_speed': True,
-        'iso': True,
-        'date': True,
-        'time': True,
-        'gps': False,
-    },
-    'icons': {
-        'canon': str(ICONS_PATH / "canon.png"),
-        'leica': str(ICONS_PATH / "leica.png"),
-        'nikon': str(ICONS_PATH / "nikon.png"),
-        'sony': str(ICONS_PATH / "sony.png"),
-        'olympus': str(ICONS_PATH / "olympus.png"),
-        'panasonic': str(ICONS_PATH / "panasonic.png"),
-        'fujifilm': str(ICONS_PATH / "fujifilm.png"),
-        'apple': str(ICONS_PATH / "apple.png"),
-        'xiaomi': str(ICONS_PATH / "xiaomi.png"),
-        'huawei': str(ICONS_PATH / "huawei.png"),
-    }
-}
 
-class IntroWindow(QWidget):
+def pil_to_pixmap(img):
+    # GUI thread only. The QImage borrows `data` without copying and
+    # QPixmap.fromImage uploads it while `data` is still alive.
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    data = img.tobytes()
+    return QPixmap.fromImage(QImage(data, img.size[0], img.size[1], img.size[0] * 3, QImage.Format_RGB888))
+
+
+def strip_key(img_path, config):
+    # a preview whose key matches only differs from the last one in show_info,
+    # which lives entirely in the text strip
+    return img_path, {key: value for key, value in config.items() if key != 'show_info'}
+
+
+class PreviewWorker(QThread):
+    # renders one preview at a time; a new request replaces any that is still waiting
+    # PIL images, turned into pixmaps on the GUI thread
+    ready = pyqtSignal(int, object, object)
+    failed = pyqtSignal(int, str)
+
     def __init__(self):
+        super().__init__()
+        self.cond = threading.Condition()
+        self.request = None
+        self.running = True
+        # (strip_key, source, watermarked) of the last preview, worker thread only
+        self.last = None
+
+    def submit(self, generation, img_path, config):
+        with self.cond:
+            self.request = (generation, img_path, config)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.request is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                generation, img_path, config = self.request
+                self.request = None
+            try:
+                import watermark
+                key = strip_key(img_path, config)
+                if self.last and self.last[0] == key:
+                    img, watermarked = watermark.redraw_preview(img_path, self.last[1], self.last[2], config)
+                else:
+                    img, watermarked = watermark.render_preview(img_path, config)
+                self.last = (key, img, watermarked)
+                self.ready.emit(generation, img, watermarked)
+            except Exception as e:
+                self.last = None
+                self.failed.emit(generation, f"{img_path}: {type(e).__name__}: {e}")
+
+
+class ConfigWriter(QObject):
+    # write-behind for option toggles: a burst of edits is saved once, after
+    # `delay` ms without another one, and whatever is pending is saved on close
+    def __init__(self, config, config_path, delay=500):
+        super().__init__()
+        self.config = config
+        self.config_path = config_path
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.flush)
+
+    def schedule(self):
+        self.timer.start()
+
+    def flush(self):
+        self.timer.stop()
+        save_config(self.config, self.config_path)
+
+    def flush_pending(self):
+        if self.timer.isActive():
+            self.flush()
+
+
+class ThumbTask(QRunnable):
+    def __init__(self, loader, row, img_path):
+        super().__init__()
+        self.loader = loader
+        self.row = row
+        self.img_path = img_path
+
+    def run(self):
+        try:
+            thumb = self.loader.cache.get(self.img_path)
+        except Exception as e:
+            logger.error(f"{self.img_path}: {type(e).__name__}: {e}")
+            return
+        self.loader.loaded.emit(self.row, self.img_path, thumb)
+
+
+class ThumbLoader(QObject):
+    # decodes thumbnails on a thread pool, only for the rows asked for last
+    loaded = pyqtSignal(int, str, object)
+
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+        self.pool = QThreadPool()
+
+    def request(self, jobs):
+        # rows that scrolled out of view before a thread picked them up are dropped
+        self.pool.clear()
+        for row, img_path in jobs:
+            self.pool.start(ThumbTask(self, row, img_path))
+
+
+class ScanWorker(QThread):
+    # lists the folder tree off the GUI thread, one signal per directory of
+    # (relative path, path) pairs
+    found = pyqtSignal(list)
+
+    def __init__(self, folder_path, scan_filter, parent=None):
+        # parented, a replaced scan may still be running when the window drops it
+        super().__init__(parent)
+        self.folder_path = folder_path
+        self.scan_filter = scan_filter
+
+    def run(self):
+        from scan import scan
+        batches = scan([self.folder_path], self.scan_filter)
+        try:
+            for batch in batches:
+                if self.isInterruptionRequested():
+                    break
+                self.found.emit([(os.path.relpath(found.path, found.root), found.path) for found in batch])
+        finally:
+            batches.close()
+
+
+class BatchWorker(QThread):
+    # runs the process pool off the GUI thread, signals are queued back to it
+    progress = pyqtSignal(int, int)
+    # failed images, and the error that stopped the whole batch if any
+    done = pyqtSignal(int, str)
+
+    def __init__(self, jobs, config):
+        super().__init__()
+        self.jobs = jobs
+        self.config = config.dict()
+
+    def run(self):
+        from batch import run_batch
+        from manifest import ExportManifest
+        batch = self.config['batch']
+        # only new or changed images, finished ones survive an interrupted run
+        manifest = ExportManifest(self.config)
+        failed, error = [], ""
+        try:
+            jobs = manifest.pending(self.jobs)
+            self.progress.emit(0, len(jobs))
+            failed = run_batch(jobs, self.config, batch['workers'], batch['max_in_flight'],
+                               progress=self.progress.emit, on_success=manifest.record)
+        except Exception as e:
+            # e.g. BrokenProcessPool after a worker was killed; the window still
+            # needs its done signal to give the button back
+            logger.exception("batch stopped")
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            try:
+                manifest.flush()
+            except OSError as e:
+                logger.error(f"cannot write the export manifest: {e}")
+            self.done.emit(len(failed), error)
+
+
+class IntroWindow(QWidget):
+    def __init__(self, config_path=CONFIG_PATH):
         super().__init__()
         self.setWindowTitle("LEICA WATERMARK - Intro")
         self.layout = QHBoxLayout()
@@ -78,24 +207,15 @@ class IntroWindow(QWidget):
         self.layout.addWidget(self.open_new_folder_button)
         self.setLayout(self.layout)
 
-        self.config_path = Path(__file__).parent / "asset" / "config.yaml"
-        
-        try:
-            self.config = ez.load(self.config_path)
-        except:
-            self.config = ez.Config()
-            self.config.dump(self.config_path)
-
-
+        self.config_path = config_path
         self.check_config()
         logger.info(self.config)
     
-    def check_config(self):        
-        self.config_ = ez.Config(CONFIG_TEMPLATE)
-        self.config_.update(self.config)
-        self.config = self.config_
-        
-        self.config.dump(self.config_path)
+    def check_config(self):
+        # options added since the file was written are filled in from the
+        # template; the file is only rewritten when that changes it
+        self.config = load_config(self.config_path)
+        save_config(self.config, self.config_path)
     
     def open_last_folder(self):
         if self.config['max_folder_history'] > 0 and self.config['folder_history'] != None and len(self.config['folder_history']) > 0:
@@ -121,20 +241,23 @@ class IntroWindow(QWidget):
                 self.config['folder_history'] = self.config['folder_history'][-self.config['max_folder_history']:]
             
         self.config['export_folder'] = os.path.join(folder_path, "export")
-        self.config.dump(self.config_path)
+        save_config(self.config, self.config_path)
         
         self.hide()
-        self.main_window = MainWindow(folder_path)
+        # the main window works on this same config object
+        self.main_window = MainWindow(folder_path, self.config, self.config_path)
         self.main_window.show()
 
 class MainWindow(QWidget):
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, config=None, config_path=CONFIG_PATH):
         super().__init__()
         self.setWindowTitle("LEICA WATERMARK - Main")
         self.setFixedSize(1200, 800)
+        # a folder is open: Pillow is about to be loaded anyway
+        allow_large_images()
         self.folder_path = folder_path
-        self.config = ez.load(Path(__file__).parent / "asset" / "config.yaml")
-        logger.info(self.config)
+        self.config = config if config is not None else load_config(config_path)
+        self.config_writer = ConfigWriter(self.config, config_path)
         self.initUI()
 
     def initUI(self):
@@ -169,19 +292,108 @@ class MainWindow(QWidget):
 
         self.setLayout(self.grid)
 
-        for img in os.listdir(self.folder_path):
-            if img.lower().endswith(('.png', '.jpg', '.jpeg')):
-                pixmap = QPixmap(os.path.join(self.folder_path, img)).scaled(100, 100, Qt.KeepAspectRatio)
-                item = QListWidgetItem(QIcon(pixmap), img)
-                self.thumbView.addItem(item)
+        # thumbnails are filled in lazily, see load_visible_thumbs
+        placeholder = QPixmap(THUMB_SIZE, THUMB_SIZE)
+        placeholder.fill(QColor(224, 224, 224))
+        self.placeholder = QIcon(placeholder)
+
+        from thumbcache import ThumbCache
+        self.thumbs_loaded = set()
+        self.thumb_loader = ThumbLoader(ThumbCache(max_bytes=self.config['thumb_cache_mb'] * 1024 * 1024))
+        self.thumb_loader.loaded.connect(self.thumb_loaded)
+        self.thumbView.horizontalScrollBar().valueChanged.connect(self.load_visible_thumbs)
+        self.thumbView.verticalScrollBar().valueChanged.connect(self.load_visible_thumbs)
 
         self.scroll = QScrollArea()
         self.scroll.setWidget(self.thumbView)
         self.scroll.setWidgetResizable(True)
         self.grid.addWidget(self.scroll, 0, 0, 2, 1)
 
+        self.preview_generation = 0
+        self.preview_worker = PreviewWorker()
+        self.preview_worker.ready.connect(self.preview_ready)
+        self.preview_worker.failed.connect(self.preview_failed)
+        self.preview_worker.start()
+
         self.thumbView.currentRowChanged.connect(self.show_image)
-        self.show_image(0)
+        # items arrive from the scan, the first one is shown once it is there
+        self.scan_worker = None
+        self.batching = False
+        self.rescan()
+
+    def rescan(self):
+        from scan import ScanFilter
+        try:
+            scan_filter = ScanFilter(*(edit.text().strip() for edit in self.filter_edits))
+        except ValueError as e:
+            QMessageBox.warning(self, "Filter", str(e))
+            return
+        # finished scans are already deleted, the running one is a child of the window
+        for worker in self.findChildren(ScanWorker):
+            worker.requestInterruption()
+        self.thumbView.clear()
+        self.current_index = -1
+        self.thumbs_loaded = set()
+        self.scan_worker = ScanWorker(self.folder_path, scan_filter, self)
+        self.scan_worker.found.connect(self.scan_found)
+        self.scan_worker.finished.connect(self.scan_finished)
+        self.scan_worker.finished.connect(self.scan_worker.deleteLater)
+        self.scan_worker.start()
+        self.update_batch_btn()
+
+    def scan_found(self, images):
+        if self.sender() is not self.scan_worker:
+            # still queued from the scan before the last rescan
+            return
+        for rel, _ in images:
+            self.thumbView.addItem(QListWidgetItem(self.placeholder, rel))
+        if self.thumbView.currentRow() < 0:
+            self.thumbView.setCurrentRow(0)
+        self.load_visible_thumbs()
+
+    def scan_finished(self):
+        if self.sender() is self.scan_worker:
+            # every directory is listed, the batch exports all of them
+            self.scan_worker = None
+            self.update_batch_btn()
+
+    def update_batch_btn(self):
+        # a batch takes the rows listed, wait until the scan has listed them all
+        self.batch_btn.setEnabled(self.scan_worker is None and not self.batching)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.load_visible_thumbs()
+
+    def visible_thumb_rows(self, ahead=10):
+        viewport = self.thumbView.viewport().rect()
+        first = self.thumbView.indexAt(viewport.topLeft() + QPoint(5, 5))
+        row = first.row() if first.isValid() else 0
+        rows = []
+        while row < self.thumbView.count():
+            rect = self.thumbView.visualItemRect(self.thumbView.item(row))
+            if rect.top() > viewport.bottom():
+                break
+            if rect.intersects(viewport):
+                rows.append(row)
+            row += 1
+        # prefetch the next few so slow scrolling does not show placeholders
+        return rows + list(range(row, min(row + ahead, self.thumbView.count())))
+
+    def load_visible_thumbs(self, *args):
+        jobs = []
+        for row in self.visible_thumb_rows():
+            if row not in self.thumbs_loaded:
+                jobs.append((row, os.path.join(self.folder_path, self.thumbView.item(row).text())))
+        self.thumb_loader.request(jobs)
+
+    def thumb_loaded(self, row, img_path, img):
+        item = self.thumbView.item(row)
+        # the list was rescanned since the thumbnail was asked for
+        if item is None or os.path.join(self.folder_path, item.text()) != img_path:
+            return
+        self.thumbs_loaded.add(row)
+        self.thumbView.item(row).setIcon(QIcon(pil_to_pixmap(img)))
 
     def set_control_panel(self):
         self.imgInfo.setSelectionMode(QAbstractItemView.NoSelection)
@@ -197,6 +409,17 @@ class MainWindow(QWidget):
         
         self.imgInfo.itemChanged.connect(self.update_info)
 
+        # filters of the thumbnail list, which is also what Batch Process exports
+        self.filterLayout = QFormLayout()
+        self.filter_edits = []
+        for label, placeholder in (('Maker', 'e.g. leica'), ('Lens', 'e.g. summilux'),
+                                   ('Since', 'YYYY[-MM[-DD]]'), ('Until', 'YYYY[-MM[-DD]]')):
+            edit = QLineEdit()
+            edit.setPlaceholderText(placeholder)
+            edit.returnPressed.connect(self.rescan)
+            self.filter_edits.append(edit)
+            self.filterLayout.addRow(label, edit)
+
         self.controlPanelLayout = QVBoxLayout()
         self.regenerate_btn = QPushButton('Regenerate')
         self.regenerate_btn.clicked.connect(self.show_image)
@@ -207,6 +430,7 @@ class MainWindow(QWidget):
         self.progressBar = QProgressBar()
         self.progressBar.setVisible(False)
         
+        self.controlPanelLayout.addLayout(self.filterLayout)
         self.controlPanelLayout.addWidget(self.regenerate_btn)
         self.controlPanelLayout.addWidget(self.batch_btn)
         self.controlPanelLayout.addWidget(self.progressBar)
@@ -216,277 +440,80 @@ class MainWindow(QWidget):
         info_items = self.config['show_info']
         info_items[item.text()] = True if item.checkState() == Qt.Checked else False
         self.config['show_info'] = info_items
-        self.config.dump(Path(__file__).parent / "asset" / "config.yaml")
-        self.show_image(self.current_index)
-
-    def process_single(self, img_path):
-        target_dict = self.get_image_info(img_path)
-        watermarked = Image.open(img_path).convert('RGBA')
-        watermarked = self.add_watermark(watermarked, target_dict)
-        watermarked = watermarked.convert('RGB')
-        watermarked.save(os.path.join(self.config['export_folder'], os.path.basename(img_path)))
+        # saved once the toggling stops; the preview worker only keeps the
+        # latest request and repaints just the text strip for it
+        self.config_writer.schedule()
+        self.show_image(self.thumbView.currentRow())
 
     def show_image(self, index = -1):
         if index == -1:
             index = self.thumbView.currentRow()
+        item = self.thumbView.item(index)
+        # nothing listed yet, or a row the last rescan removed
+        if item is None:
+            return
         self.current_index = index
-        filename = self.thumbView.item(index).text()
+        filename = item.text()
         img_path = os.path.join(self.folder_path, filename)
-        
-        img = QImage(img_path)
-        self.imgView.setPixmap(QPixmap.fromImage(img).scaled(500, 500, Qt.KeepAspectRatio))
 
-        target_dict = self.get_image_info(img_path)        
-        logger.info(target_dict)
-        
-        # add watermark
-        watermarked = Image.open(img_path).convert('RGBA')
-        watermarked = self.add_watermark(watermarked, target_dict)
-        watermarked = QImage(watermarked.tobytes(), watermarked.size[0], watermarked.size[1], QImage.Format_RGBA8888)
-        self.imgWMView.setPixmap(QPixmap.fromImage(watermarked).scaled(500, 500, Qt.KeepAspectRatio))
-    
-    def get_image_info(self, img_path):
-        f = Image.open(img_path)
-        # info = ''
-        piexif_dict = piexif.load(f.info['exif'])
-        target_dict = {
-            'camera': piexif_dict['0th'][272].decode('utf-8'),
-            'camera_maker': piexif_dict['0th'][271].decode('utf-8'),
-            'lens': piexif_dict['Exif'][42036].decode('utf-8'),
-            'focal_length': piexif_dict['Exif'][37386][0]/piexif_dict['Exif'][37386][1],
-            'aperture': piexif_dict['Exif'][33437][0]/piexif_dict['Exif'][33437][1],
-            'shutter_speed': piexif_dict['Exif'][33434][0]/piexif_dict['Exif'][33434][1],
-            'iso': piexif_dict['Exif'][34855],
-            'date': piexif_dict['Exif'][36867].decode('utf-8'),
-            'time': piexif_dict['Exif'][36868].decode('utf-8'),
-            'gps': piexif_dict['GPS']
-        }
-
-        target_dict['focal_length'] = f"{target_dict['focal_length']}mm"
-        target_dict['aperture'] = f"f/{target_dict['aperture']}"
-        target_dict['shutter_speed'] = self.get_shutter_speed(target_dict['shutter_speed'])
-        target_dict['iso'] = f"ISO {target_dict['iso']}"
-        target_dict['date'] = target_dict['date'].split(' ')[0].replace(':', '-')
-        target_dict['time'] = target_dict['time'].split(' ')[1]
-
-        return target_dict
+        # rendered on the preview worker, results of older requests are dropped
+        self.preview_generation += 1
+        self.preview_worker.submit(self.preview_generation, img_path, self.config.dict())
+
+    def preview_ready(self, generation, img, watermarked):
+        if generation != self.preview_generation:
+            return
+        self.imgView.setPixmap(pil_to_pixmap(img).scaled(PREVIEW_SIZE, PREVIEW_SIZE, Qt.KeepAspectRatio))
+        self.imgWMView.setPixmap(pil_to_pixmap(watermarked).scaled(PREVIEW_SIZE, PREVIEW_SIZE, Qt.KeepAspectRatio))
+
+    def preview_failed(self, generation, error):
+        if generation == self.preview_generation:
+            logger.error(error)
+
+    def closeEvent(self, event):
+        self.config_writer.flush_pending()
+        self.preview_worker.stop()
+        for worker in self.findChildren(ScanWorker):
+            worker.requestInterruption()
+            worker.wait()
+        super().closeEvent(event)
 
     def batch_process(self):
         # 显示progressBar
         self.progressBar.setVisible(True)
+        self.batching = True
+        self.update_batch_btn()
         
-        if not os.path.exists(self.config['export_folder']):
-            os.mkdir(self.config['export_folder'])
-        
-        # get all images
-        images = []
-        for img in os.listdir(self.folder_path):
-            if img.lower().endswith(('.png', '.jpg', '.jpeg')):
-                images.append(img)
+        import encoders
+        # the images listed, sub folders mirrored below the export folder
+        images = [self.thumbView.item(row).text() for row in range(self.thumbView.count())]
+        jobs = [(os.path.join(self.folder_path, img), encoders.output_path(os.path.join(self.config['export_folder'], img), self.config['output']))
+                for img in images]
+        for folder in {os.path.dirname(dst) for _, dst in jobs}:
+            os.makedirs(folder, exist_ok=True)
         
         # set progressBar
         self.progressBar.setMaximum(len(images))
         self.progressBar.setValue(0)
 
         # process
+        self.batch_worker = BatchWorker(jobs, self.config)
+        self.batch_worker.progress.connect(self.batch_progress)
+        self.batch_worker.done.connect(self.batch_done)
+        self.batch_worker.start()
 
-        for img in images:
-            self.process_single(os.path.join(self.folder_path, img))
-            self.progressBar.setValue(self.progressBar.value() + 1)
-        
+    def batch_progress(self, done, total):
+        self.progressBar.setMaximum(total)
+        self.progressBar.setValue(done)
+
+    def batch_done(self, failed, error):
         # hide progressBar
         self.progressBar.setVisible(False)
-        QMessageBox.information(self, "Done", "Batch process done")
-
-    @staticmethod
-    def get_shutter_speed(value):
-        if value < 1:
-            return f"1/{int(1/value)}s"
-        else:
-            return f"{int(value)}s"
-    
-    def add_watermark(self, img, info_dict):
-        wm_config = self.config['watermark']
-        img_size = img.size
-
-        self.img_size = img_size
-        logger.info(f"img size: {img_size}")
-
-        # composition
-        self.composition = self.img_size[0] > self.img_size[1] # True: landscape, False: portrait
-
-        # border
-        border_size = wm_config['border']['size']
-        border_size = self.deal_height_weight_type(border_size, img_size)
-        
-        self.border_size = border_size
-        logger.info(f"border size: {border_size}")
-
-        if ":" in wm_config['border']['ratio']:
-            border_ratio = wm_config['border']['ratio'].split(':')
-            if int(border_ratio[0]) < int(border_ratio[1]):
-                border_ratio = int(border_ratio[1]) / int(border_ratio[0])
-            else:
-                border_ratio = int(border_ratio[0]) / int(border_ratio[1])
-        else:
-            border_ratio = None
-
-        self.border_ratio = border_ratio
-        logger.info(f"border ratio: {border_ratio}")
-
-        # text area size
-        text_area_size = wm_config['text_area']['width'], wm_config['text_area']['height']
-        text_area_size = self.deal_height_weight_type(text_area_size, img_size)
-        
-        self.text_area_size = text_area_size
-        logger.info(f"text area size: {text_area_size}")
-
-        # new image size
-        # always bottom
-        nheight = img_size[1] + text_area_size[1] + border_size[1]
-        nwidth = nheight * border_ratio if border_ratio else img_size[0] + border_size[0] * 2
-
-        nheight = int(nheight)
-        nwidth = int(nwidth)
-
-        self.nheight = nheight
-        self.nwidth = nwidth
-        logger.info(f"new image size: {nwidth}x{nheight}")
-
-        nimg = Image.new('RGBA', (nwidth, nheight), tuple(wm_config['bg_color']))
-        nimg.paste(img, (int((nwidth-img_size[0])/2), border_size[1]))
-
-        # font
-        font_size = wm_config['font_size']
-        if type(font_size) == str and '%' in font_size:
-            font_size = self.get_percent(font_size, text_area_size[1])
-        
-        font_size = int(min(font_size, text_area_size[0] / 30))
-        
-        self.font_size = font_size
-        logger.info(f"font size: {font_size}")
-
-        bold_font = ImageFont.truetype(wm_config['font']['bold'], font_size)
-        light_font = ImageFont.truetype(wm_config['font']['light'], int(font_size * 0.8))
-        font = {
-            'bold': bold_font,
-            'light': light_font
-        }
-
-        # camera text
-        self.draw_camera_text(nimg, info_dict, font)
-        logger.info(f"draw camera text done")
-
-        # detail text
-        self.draw_detail_text(nimg, info_dict, font)
-        logger.info(f"draw detail text done")
-
-        # icon
-        icon_path = self.get_icon_path(info_dict['camera_maker'])
-        if icon_path and self.config['show_info']['camera_maker']:
-            # to PIL
-            icon = Image.open(str(icon_path)).convert('RGBA')
-            icon_height = font_size * 2 if self.composition else font_size
-            icon_width = int(icon_height * icon.size[0] / icon.size[1])
-            icon = icon.resize((icon_width, icon_height))
-            logger.info(f"icon size: {icon.size}")
-            self.draw_icon(nimg, icon)
-        
-        # nimg.save(str(TEMP_PATH / "watermarked.png"))
-        return nimg
-
-    @staticmethod
-    def get_percent(value, total):
-        value = int(value.split('%')[0])
-        return int(1.0*value*total/100)
-    
-    def deal_height_weight_type(self, value, img_size):
-        if type(value) == int:
-            return (value, value)
-        elif (type(value) == list or type(value) == tuple) and len(value) == 2:
-            value = list(value)
-            if '%' in value[0]:
-                value[0] = self.get_percent(value[0], img_size[0])
-            if '%' in value[1]:
-                value[1] = self.get_percent(value[1], img_size[1])
-            return (value[0], value[1])
-        elif type(value) == str and '%' in value:
-            value = value.split('%')[0]
-            return (self.get_percent(value, img_size[0]), self.get_percent(value, img_size[1]))
-
-    def get_icon_path(self, camera_maker):
-        for key, value in self.config['icons'].items():
-            if key.lower() in camera_maker.lower():
-                return value
-        return self.config['icons']['leica']
-
-    def draw_icon(self, img, icon):
-
-        if self.composition:
-            self.margin = self.get_percent(self.config['watermark']['margin'], self.text_area_size[0]) if '%' in str(self.config['watermark']['margin']) else self.config['watermark']['margin']
-            logger.info(f"margin: {self.margin}")
-            self.div_line_width = self.get_percent(self.config['watermark']['div_line_width'], self.text_area_size[0]) if '%' in str(self.config['watermark']['div_line_width']) else int(self.config['watermark']['div_line_width'])
-            self.div_line_width = min(self.div_line_width, 20, int(self.nwidth / 500))
-            logger.info(f"div line width: {self.div_line_width}")
-            icon_pos = (int(self.start_pos_width - icon.size[0] - self.margin * 2 - self.div_line_width), int(self.nheight-self.text_area_size[1] + (self.text_area_size[1]-icon.size[1])/2))
-            img.paste(icon, icon_pos, icon)
-            
-            # draw div line
-            draw = ImageDraw.Draw(img)
-            draw.line((self.start_pos_width - self.margin - self.div_line_width, icon_pos[1], self.start_pos_width - self.margin - self.div_line_width, icon_pos[1] + icon.size[1]), fill=tuple(self.config['watermark']['div_line_color']), width=int(self.div_line_width))
+        self.batching = False
+        self.update_batch_btn()
+        if error:
+            QMessageBox.warning(self, "Done", f"Batch process stopped: {error}")
+        elif failed:
+            QMessageBox.warning(self, "Done", f"Batch process done, {failed} images failed")
         else:
-            self.margin = self.get_percent(self.config['watermark']['margin'], self.text_area_size[0]) if '%' in str(self.config['watermark']['margin']) else self.config['watermark']['margin']
-            logger.info(f"margin: {self.margin}")
-            icon_pos = (int(self.start_pos_width_dt - icon.size[0] - self.margin * 2), self.nheight-self.text_area_size[1] + int(self.font_size / 0.8) + int((self.text_area_size[1]-2*self.font_size)/5 * 3 - self.font_size / 0.8 * 0.2))
-            img.paste(icon, icon_pos, icon)
-        return img
-
-    def draw_camera_text(self, img, info, font):
-        draw = ImageDraw.Draw(img)
-        if self.config['show_info']['camera']:
-            text = info['camera']
-            text_size = draw.textsize(text, font['bold'])
-            logger.info(f"camera text size: {text_size}")
-            text_pos = (int(self.border_size[0]), self.nheight-self.text_area_size[1] + int((self.text_area_size[1]-2*text_size[1])/5*2))
-            draw.text(text_pos, text, tuple(self.config['watermark']['font_color']), font=font['bold'])
-
-        if self.config['show_info']['lens']:
-            text = info['lens']
-            text_size = draw.textsize(text, font['light'])
-            logger.info(f"lens text size: {text_size}")
-            text_pos = (int(self.border_size[0]), self.nheight-self.text_area_size[1] + int(text_size[1] / 0.8) + int((self.text_area_size[1]-2*text_size[1])/5*3))
-            draw.text(text_pos, text, tuple(self.config['watermark']['font_color']), font=font['light'])
-        return img
-
-    def draw_detail_text(self, img, info, font):
-        draw = ImageDraw.Draw(img)
-        text = ""
-        if self.config['show_info']['focal_length']:
-            text += info['focal_length']
-        if self.config['show_info']['aperture']:
-            text += ' ' + info['aperture']
-        if self.config['show_info']['shutter_speed']:
-            text += ' ' + info['shutter_speed']
-        if self.config['show_info']['iso']:
-            text += ' ' + info['iso']
-        text_size = draw.textsize(text, font['bold'])
-        logger.info(f"detail text size: {text_size}")
-        text_pos = (int(self.nwidth - self.border_size[0] - text_size[0]), self.nheight-self.text_area_size[1] + int((self.text_area_size[1]-2*text_size[1])/5*2))
-        draw.text(text_pos, text, tuple(self.config['watermark']['font_color']), font=font['bold'])
-
-        self.start_pos_width = text_pos[0]
-
-        text = ""
-        if self.config['show_info']['date']:
-            text += info['date']
-        if self.config['show_info']['time']:
-            text += ' ' + info['time']
-        text_size = draw.textsize(text, font['light'])
-        logger.info(f"date text size: {text_size}")
-        text_pos = (int(self.nwidth - self.border_size[0] - text_size[0]), self.nheight-self.text_area_size[1] + int(text_size[1] / 0.8) + int((self.text_area_size[1]-2*text_size[1])/5*3))
-        draw.text(text_pos, text, tuple(self.config['watermark']['font_color']), font=font['light'])
-
-        self.start_pos_width_dt = text_pos[0]
-        self.start_pos_width = min(self.start_pos_width, text_pos[0])
-
-        return img
\ No newline at end of file
+            QMessageBox.information(self, "Done", "Batch process done")
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from exif import cached_image_info
+import watermark
+
+MANIFEST_NAME = ".watermark-manifest.json"
+
+
+def source_key(img_path):
+    st = os.stat(img_path)
+    ident = f"{os.path.abspath(img_path)}\0{st.st_mtime_ns}\0{st.st_size}"
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+
+def render_key(info, config):
+    # pixels and encoder settings, either one changing makes the export stale
+    output = config['output'].dict() if hasattr(config['output'], 'dict') else config['output']
+    signature = json.dumps({'render': watermark.render_signature(info, config), 'output': output}, sort_keys=True)
+    return hashlib.sha1(signature.encode('utf-8')).hexdigest()
+
+
+class ExportManifest:
+    """Records which source and render config produced each export.
+
+    One json file per export folder. `pending` drops jobs whose export is
+    still current; `record` marks a job done and is flushed every few seconds,
+    so an interrupted batch resumes from where it stopped.
+    """
+
+    def __init__(self, config, flush_interval=2.0):
+        self.config = config
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.folders = {}
+        self.dirty = set()
+        self.keys = {}
+        self.last_flush = time.monotonic()
+
+    def folder(self, folder):
+        if folder not in self.folders:
+            try:
+                with open(os.path.join(folder, MANIFEST_NAME), encoding='utf-8') as f:
+                    self.folders[folder] = json.load(f)
+            except (OSError, ValueError):
+                self.folders[folder] = {}
+        return self.folders[folder]
+
+    def pending(self, jobs):
+        todo = []
+        for src, dst in jobs:
+            try:
+                keys = {'source': source_key(src), 'render': render_key(cached_image_info(src), self.config)}
+            except Exception:
+                # unreadable source: let the render report the error
+                todo.append((src, dst))
+                continue
+            folder, name = os.path.split(dst)
+            with self.lock:
+                entry = self.folder(folder).get(name)
+                self.keys[dst] = keys
+            if entry != keys or not os.path.exists(dst):
+                todo.append((src, dst))
+        return todo
+
+    def record(self, src, dst):
+        folder, name = os.path.split(dst)
+        with self.lock:
+            keys = self.keys.get(dst)
+            if keys is None:
+                return
+            self.folder(folder)[name] = keys
+            self.dirty.add(folder)
+            if time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        for folder in self.dirty:
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, MANIFEST_NAME)
+            tmp = path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.folders[folder], f)
+            os.replace(tmp, path)
+        self.dirty.clear()
+        self.last_flush = time.monotonic()
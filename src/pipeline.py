@@ -0,0 +1,160 @@
+import os
+import queue
+import threading
+import time
+from loguru import logger
+import watermark
+
+# Streaming export: reader -> compositor -> writer threads joined by bounded
+# queues, so disk reads, compositing and JPEG encoding overlap. Pillow releases
+# the GIL while decoding, pasting and encoding, which is where the time goes.
+
+DONE = object()
+
+
+class StageStats:
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.items = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.max_depth = 0
+
+    def record(self, seconds, ok=True):
+        with self.lock:
+            self.items += 1
+            self.busy += seconds
+            if not ok:
+                self.failed += 1
+
+    def observe_depth(self, depth):
+        with self.lock:
+            self.max_depth = max(self.max_depth, depth)
+
+    def snapshot(self, elapsed, inbox):
+        depth = inbox.qsize()
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'items': self.items,
+                'failed': self.failed,
+                'busy_seconds': round(self.busy, 3),
+                'items_per_second': round(self.items / elapsed, 2) if elapsed else 0.0,
+                # share of the stage's thread time spent working
+                'utilization': round(self.busy / (elapsed * self.workers), 3) if elapsed else 0.0,
+                'queue_depth': depth,
+                'max_queue_depth': self.max_depth,
+            }
+
+
+class Pipeline:
+    def __init__(self, config, readers=2, compositors=0, writers=2, queue_size=4):
+        self.config = config.dict() if hasattr(config, 'dict') else config
+        compositors = compositors or os.cpu_count() or 1
+        self.stages = [
+            ('read', readers, self.read),
+            ('composite', compositors, self.composite),
+            ('write', writers, self.write),
+        ]
+        # queue i feeds stage i; bounded, so a fast reader cannot pile up frames
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in self.stages]
+        self.stats = {name: StageStats(name, workers) for name, workers, _ in self.stages}
+        self.failed = []
+        self.failed_lock = threading.Lock()
+        self.done = 0
+        self.total = 0
+        self.started = None
+
+    def read(self, job):
+        src, dst = job
+        canvas, layout, target_dict = watermark.decode(src, self.config)
+        return src, dst, canvas, layout, target_dict
+
+    def composite(self, job):
+        src, dst, canvas, layout, target_dict = job
+        return src, dst, watermark.render(canvas, layout, target_dict, self.config)
+
+    def write(self, job):
+        src, dst, watermarked = job
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        watermark.encode(watermarked, dst, self.config['output'])
+        return src, dst
+
+    def snapshot(self):
+        """Per-stage throughput and queue depth, safe to call while running."""
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        return {name: self.stats[name].snapshot(elapsed, self.queues[i]) for i, (name, _, _) in enumerate(self.stages)}
+
+    def finish(self, src, dst, error, progress, on_success):
+        # last stop of every job; a callback that raises must not take its
+        # worker thread down, the stages upstream would block on full queues
+        if error is None and on_success:
+            try:
+                on_success(src, dst)
+            except Exception as e:
+                error = f"on_success: {type(e).__name__}: {e}"
+        with self.failed_lock:
+            if error is not None:
+                logger.error(f"{src}: {error}")
+                self.failed.append((src, error))
+            self.done += 1
+            done = self.done
+        if progress:
+            try:
+                progress(done, self.total)
+            except Exception as e:
+                logger.error(f"progress callback: {type(e).__name__}: {e}")
+
+    def worker(self, index, progress, on_success):
+        name, _, func = self.stages[index]
+        inbox = self.queues[index]
+        outbox = self.queues[index + 1] if index + 1 < len(self.queues) else None
+        stats = self.stats[name]
+        while True:
+            job = inbox.get()
+            if job is DONE:
+                return
+            start = time.perf_counter()
+            try:
+                result = func(job)
+            except Exception as e:
+                stats.record(time.perf_counter() - start, ok=False)
+                self.finish(job[0], job[1], f"{type(e).__name__}: {e}", progress, on_success)
+                continue
+            stats.record(time.perf_counter() - start)
+            if outbox is not None:
+                outbox.put(result)
+                self.stats[self.stages[index + 1][0]].observe_depth(outbox.qsize())
+                continue
+            self.finish(*result, None, progress, on_success)
+
+    def run(self, jobs, progress=None, on_success=None):
+        """Export (src, dst) jobs and return the list of (src, error) failures.
+
+        `progress(done, total)` is called from a worker thread whenever an
+        image is written or fails, as in batch.run_batch, `on_success(src, dst)`
+        whenever one is written. Callbacks that raise count as failed images.
+        """
+        jobs = list(jobs)
+        self.total = len(jobs)
+        self.started = time.perf_counter()
+        threads = []
+        for index, (name, workers, _) in enumerate(self.stages):
+            group = [threading.Thread(target=self.worker, args=(index, progress, on_success), name=f"{name}-{i}", daemon=True) for i in range(workers)]
+            for thread in group:
+                thread.start()
+            threads.append(group)
+
+        for job in jobs:
+            self.queues[0].put(job)
+            self.stats['read'].observe_depth(self.queues[0].qsize())
+
+        # shut the stages down in order once everything upstream has drained
+        for index, group in enumerate(threads):
+            for _ in group:
+                self.queues[index].put(DONE)
+            for thread in group:
+                thread.join()
+        return self.failed
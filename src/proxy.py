@@ -0,0 +1,44 @@
+import io
+from PIL import Image
+import piexif
+
+# Reduced resolution decoding for thumbnails and previews. Cheapest source first:
+# the embedded EXIF thumbnail, then libjpeg DCT scaling (draft), then a full decode.
+
+
+def exif_thumbnail(img, size):
+    exif = img.info.get('exif')
+    if not exif:
+        return None
+    try:
+        data = piexif.load(exif).get('thumbnail')
+    except Exception:
+        return None
+    if not data:
+        return None
+    thumb = Image.open(io.BytesIO(data))
+    # letterboxed or too small thumbnails would not match the real frame
+    if max(thumb.size) < size:
+        return None
+    if abs(thumb.size[0] / thumb.size[1] - img.size[0] / img.size[1]) > 0.02:
+        return None
+    return thumb
+
+
+def open_proxy(img_path, size):
+    """Return (image, full_size) with the image fitting in a size x size box.
+
+    full_size is the resolution of the original, so callers can scale layout
+    math computed for the export down to the proxy.
+    """
+    img = Image.open(img_path)
+    full_size = img.size
+
+    proxy = exif_thumbnail(img, size) if img.format == 'JPEG' else None
+    if proxy is None:
+        proxy = img
+        if img.format == 'JPEG':
+            # decodes at 1/2, 1/4 or 1/8 scale, never below the requested box
+            img.draft('RGB', (size, size))
+    proxy.thumbnail((size, size))
+    return proxy, full_size
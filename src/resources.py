@@ -0,0 +1,24 @@
+from functools import lru_cache
+from PIL import Image, ImageFont
+
+# Fonts and icons shared by every render in the process. The CJK fonts are
+# expensive to open, so faces are cached per (path, size) and icons per
+# (path, height); the LRU bounds keep a long mixed batch from growing forever.
+
+
+@lru_cache(maxsize=16)
+def load_font(path, size):
+    return ImageFont.truetype(path, size)
+
+
+@lru_cache(maxsize=32)
+def load_icon_source(path):
+    return Image.open(path).convert('RGBA')
+
+
+@lru_cache(maxsize=64)
+def load_icon(path, height):
+    # callers only paste from it, the cached image is never modified
+    icon = load_icon_source(path)
+    width = int(height * icon.size[0] / icon.size[1])
+    return icon.resize((width, height))
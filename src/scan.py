@@ -0,0 +1,132 @@
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from loguru import logger
+from settings import IMAGE_SUFFIXES
+from exif import ExifIndex, cached_image_info
+
+# Directory scanner shared by the thumbnail view and the batch exporters.
+# Every directory is one os.scandir call on a thread pool, so the subtrees of
+# an archive are listed side by side, and results are yielded one directory at
+# a time as they come in. Filters read the folder's EXIF index in one query;
+# only files that are new or changed since the last scan are parsed.
+#   for batch in scan(['/photos/archive'], ScanFilter(maker='leica', since='2025')):
+#       ...
+
+SCAN_THREADS = 8
+DATE = re.compile(r'^\d{4}(-\d{2}(-\d{2})?)?$')
+
+# root: the scanned folder the path was found under, info: parsed EXIF when filtered
+Found = namedtuple('Found', ['root', 'path', 'info'])
+
+
+class ScanFilter(namedtuple('ScanFilter', ['maker', 'lens', 'since', 'until'])):
+    """Camera maker and lens match case-insensitively anywhere in the tag.
+
+    since / until are YYYY, YYYY-MM or YYYY-MM-DD and both ends are inclusive,
+    until='2025' keeps all of 2025. Images without usable EXIF never match.
+    """
+
+    def __new__(cls, maker=None, lens=None, since=None, until=None):
+        for value in (since, until):
+            if value and not DATE.match(value):
+                raise ValueError(f"not a YYYY[-MM[-DD]] date: {value}")
+        return super().__new__(cls, maker and maker.lower(), lens and lens.lower(), since or None, until or None)
+
+    @property
+    def active(self):
+        return any(self)
+
+    def match(self, info):
+        if info is None:
+            return False
+        if self.maker and self.maker not in info['camera_maker'].lower():
+            return False
+        if self.lens and self.lens not in info['lens'].lower():
+            return False
+        date = info['date']
+        if self.since and date[:len(self.since)] < self.since:
+            return False
+        if self.until and date[:len(self.until)] > self.until:
+            return False
+        return True
+
+
+def file_matches(path, scan_filter):
+    # a single file named on its own, through the same index as a scanned folder
+    if not scan_filter or not scan_filter.active:
+        return True
+    try:
+        info = cached_image_info(path)
+    except Exception:
+        # no EXIF or not the tags the strip needs
+        info = None
+    return scan_filter.match(info)
+
+
+def list_dir(root, folder, recursive, scan_filter, skip):
+    # one directory: the matching images in it, and the sub folders to scan next
+    files, dirs = [], []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    # never our own exports
+                    if recursive and entry.name != "export" and entry.path not in skip:
+                        dirs.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_SUFFIXES) and entry.is_file():
+                    files.append(entry)
+    except OSError as e:
+        logger.warning(f"cannot scan {folder}: {e}")
+        return [], []
+    files.sort(key=lambda entry: entry.name)
+    if not scan_filter or not scan_filter.active:
+        return [Found(root, entry.path, None) for entry in files], dirs
+    infos = {}
+    if files:
+        # a scan reads each folder once: its own connection, closed right
+        # away, so a tree of thousands of folders does not run out of fds
+        index = ExifIndex(folder)
+        try:
+            infos = index.lookup(files)
+        finally:
+            index.close()
+    return [Found(root, entry.path, infos.get(entry.name)) for entry in files
+            if scan_filter.match(infos.get(entry.name))], dirs
+
+
+def scan(roots, scan_filter=None, recursive=True, threads=SCAN_THREADS, skip=()):
+    """Yield the images below roots as lists of Found, one list per directory.
+
+    Directories arrive in completion order, files within one are sorted by
+    name. `skip` holds absolute folder paths to leave out, e.g. a custom
+    export folder inside the tree. Closing the generator stops the scan.
+    """
+    skip = {os.path.abspath(path) for path in skip}
+    pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="scan")
+    # future -> the root folder its directory lies under
+    pending = {}
+    try:
+        for root in roots:
+            root = os.path.abspath(root)
+            pending[pool.submit(list_dir, root, root, recursive, scan_filter, skip)] = root
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                root = pending.pop(future)
+                found, dirs = future.result()
+                for folder in dirs:
+                    pending[pool.submit(list_dir, root, folder, recursive, scan_filter, skip)] = root
+                if found:
+                    yield found
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def scan_files(roots, scan_filter=None, recursive=True, threads=SCAN_THREADS, skip=()):
+    """Every Found of scan(), sorted by path."""
+    return sorted((found for batch in scan(roots, scan_filter, recursive, threads, skip) for found in batch),
+                  key=lambda found: found.path)
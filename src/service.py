@@ -0,0 +1,445 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qsl, urlsplit
+from PIL import Image, UnidentifiedImageError
+from loguru import logger
+from settings import CONFIG_PATH, allow_large_images, load_config
+from batch import init_daemon_worker, plain_config, resolve_workers, worker_stats
+from exif import info_from_exif
+from manifest import source_key
+import encoders
+import timing
+import watermark
+
+# Local render service: the watermark as an HTTP endpoint for other tools on
+# this machine, e.g. a DAM plugin or a tether script.
+#   python service.py -c config.yaml
+#   curl --data-binary @photo.jpg 'localhost:8765/render?iso=0&format=webp' -o out.webp
+#   curl -d '{"path": "/photos/a.jpg", "show_info": {"time": false}}' localhost:8765/render -o out.jpg
+#   curl localhost:8765/metrics
+# Renders run in a warm process pool, at most `max_in_flight` at once and at
+# most `max_queue` waiting for one; beyond that requests get a 503 right away.
+# Outputs are kept in an in-memory LRU keyed by source and effective config.
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+          411: 'Length Required', 413: 'Payload Too Large', 415: 'Unsupported Media Type',
+          422: 'Unprocessable Entity', 500: 'Internal Server Error', 503: 'Service Unavailable',
+          504: 'Gateway Timeout'}
+CONTENT_TYPES = {'jpeg': 'image/jpeg', 'preview': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp'}
+SOURCE_FORMATS = {'JPEG': 'jpeg', 'PNG': 'png', 'WEBP': 'webp'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def render_request(source, config):
+    """Watermark a path or image bytes in a worker, return (body, encoder, status, error, stats)."""
+    try:
+        output = config['output']
+        with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img:
+            # workers lift Pillow's bomb guard for local panoramas; uploads get
+            # a limit of their own, checked on the header before any decoding
+            limit = config['service']['max_upload_mp'] * 1e6
+            if not isinstance(source, str) and limit and img.size[0] * img.size[1] > limit:
+                return None, None, 413, f"{img.size[0]}x{img.size[1]} is above {config['service']['max_upload_mp']}MP", worker_stats()
+            if output['format'] == 'source':
+                output = dict(output, format=SOURCE_FORMATS.get(img.format, 'jpeg'))
+        if isinstance(source, str):
+            canvas, layout, info = watermark.decode(source, config)
+        else:
+            with timing.span('decode'):
+                canvas, layout = watermark.open_canvas(io.BytesIO(source), config)
+            with timing.span('exif'):
+                # open_canvas leaves the source's EXIF on the canvas
+                if not canvas.info.get('exif'):
+                    raise KeyError('exif')
+                info = info_from_exif(canvas.info['exif'])
+        data = io.BytesIO()
+        watermark.encode(watermark.render(canvas, layout, info, config), data, output)
+        return data.getvalue(), output['format'], 200, None, worker_stats()
+    except FileNotFoundError as e:
+        return None, None, 404, f"no such file: {e.filename}", worker_stats()
+    except UnidentifiedImageError:
+        return None, None, 415, "not an image Pillow can read", worker_stats()
+    except KeyError as e:
+        # no EXIF, or a tag the strip needs is missing from it
+        return None, None, 422, f"missing EXIF {e}", worker_stats()
+    except Exception as e:
+        return None, None, 500, f"{type(e).__name__}: {e}", worker_stats()
+
+
+class RenderCache:
+    """Rendered outputs in memory, least recently used dropped past max_bytes."""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, body, content_type):
+        if len(body) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.total_bytes -= len(old[0])
+        self.entries[key] = (body, content_type)
+        self.total_bytes += len(body)
+        while self.total_bytes > self.max_bytes:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'mb': round(self.total_bytes / 2 ** 20, 2),
+            'max_mb': round(self.max_bytes / 2 ** 20, 2),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+def merged_value(name, value, current):
+    # an override must look like the value it replaces; "20%" style sizes may also be pixels
+    if isinstance(current, dict):
+        if not isinstance(value, dict):
+            raise HTTPError(400, f"{name} must be an object")
+        merged = dict(current)
+        for key, item in value.items():
+            if key not in current:
+                raise HTTPError(400, f"unknown key: {name}.{key}")
+            merged[key] = merged_value(f"{name}.{key}", item, current[key])
+        return merged
+    if isinstance(current, list):
+        if not isinstance(value, list) or len(value) != len(current):
+            raise HTTPError(400, f"{name} must be a list of {len(current)}")
+        return [merged_value(f"{name}[{i}]", item, old) for i, (item, old) in enumerate(zip(value, current))]
+    if isinstance(current, bool):
+        ok = isinstance(value, bool)
+    elif isinstance(current, (int, float)):
+        ok = isinstance(value, (int, float)) and not isinstance(value, bool)
+    elif isinstance(current, str) and current.endswith('%'):
+        ok = isinstance(value, str) or isinstance(value, int) and not isinstance(value, bool)
+    else:
+        ok = isinstance(value, type(current))
+    if not ok:
+        raise HTTPError(400, f"{name} must be like {json.dumps(current)}")
+    return value
+
+
+def merge_overrides(config, show_info=None, wm=None, fmt=None):
+    # a request may only change keys the config already has, with values of the same kind
+    config = dict(config)
+    for section, overrides in (('show_info', show_info), ('watermark', wm)):
+        if overrides:
+            config[section] = merged_value(section, overrides, config[section])
+    if wm:
+        # well typed but unusable, e.g. a font_size of "abc": fail here, not in a worker
+        try:
+            watermark.get_layout((6000, 4000), config['watermark'])
+        except Exception:
+            raise HTTPError(400, "watermark overrides give no usable layout")
+    if fmt:
+        if fmt != 'source' and fmt not in encoders.ENCODERS:
+            raise HTTPError(400, f"unknown format: {fmt}")
+        config['output'] = dict(config['output'], format=fmt)
+    return config
+
+
+def config_key(config):
+    # everything a request can change that reaches the pixels or the encoder
+    signature = json.dumps({key: config[key] for key in ('show_info', 'watermark', 'icons', 'output')},
+                           sort_keys=True, default=str)
+    return hashlib.sha1(signature.encode('utf-8')).hexdigest()
+
+
+def flag(value):
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if value.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise HTTPError(400, f"not a flag: {value}")
+
+
+class RenderService:
+    def __init__(self, config, workers=0, max_in_flight=0, max_queue=64, timeout=30.0,
+                 cache_mb=256, max_body_mb=200):
+        self.config = plain_config(config)
+        self.workers, self.max_in_flight = resolve_workers(workers, max_in_flight)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.max_body = int(max_body_mb * 1024 * 1024)
+        self.cache = RenderCache(int(cache_mb * 1024 * 1024))
+        self.pool = None
+        self.slots = None
+        # cache key -> future of a render already running, shared by identical requests
+        self.rendering = {}
+        self.waiting = 0
+        self.in_flight = 0
+        self.latencies = deque(maxlen=1024)
+        self.responses = {}
+        self.started = time.monotonic()
+
+    def parse_render(self, query, headers, body):
+        """(source, config) of a POST /render: JSON with a path, or the image bytes."""
+        # image bytes never start with a brace; curl -d sends JSON as a form
+        if headers.get('content-type', '').startswith('application/json') or body.lstrip().startswith(b'{'):
+            try:
+                request = json.loads(body)
+            except ValueError:
+                raise HTTPError(400, "body is not valid JSON")
+            if not isinstance(request, dict) or not isinstance(request.get('path'), str):
+                raise HTTPError(400, "JSON body needs a \"path\"")
+            config = merge_overrides(self.config, request.get('show_info'), request.get('watermark'),
+                                     request.get('format'))
+            return request['path'], config
+        if not body:
+            raise HTTPError(400, "empty body, send the image bytes or JSON with a path")
+        # raw image: show_info flags and the format ride in the query string
+        show_info = {}
+        fmt = None
+        for key, value in query:
+            if key == 'format':
+                fmt = value
+            else:
+                show_info[key] = flag(value)
+        return body, merge_overrides(self.config, show_info, None, fmt)
+
+    def cache_key(self, source, config):
+        if isinstance(source, str):
+            # path, mtime and size, like the export manifest; the file is not read here
+            try:
+                content = source_key(source)
+            except FileNotFoundError:
+                raise HTTPError(404, f"no such file: {source}")
+            except OSError as e:
+                raise HTTPError(400, str(e))
+        else:
+            content = hashlib.sha1(source).hexdigest()
+        return f"{content}:{config_key(config)}"
+
+    async def render(self, source, config):
+        key = self.cache_key(source, config)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached, 'hit'
+        future = self.rendering.get(key)
+        if future is None:
+            if self.waiting >= self.max_queue:
+                raise HTTPError(503, f"{self.waiting} renders waiting, try again later")
+            future = asyncio.ensure_future(self.run_job(key, source, config))
+            self.rendering[key] = future
+            future.add_done_callback(lambda _: self.rendering.pop(key, None))
+        # the render keeps going after a timeout and still lands in the cache,
+        # a retry of the same request then finds it there
+        status, error, entry = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        if error:
+            raise HTTPError(status, error)
+        return entry, 'miss'
+
+    async def run_job(self, key, source, config):
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        pool = self.pool
+        try:
+            loop = asyncio.get_running_loop()
+            body, fmt, status, error, (spans, encoded) = await loop.run_in_executor(
+                pool, render_request, source, config)
+        except BrokenProcessPool:
+            # a worker died, e.g. OOM-killed; every job of that pool fails the
+            # same way, the first one to notice replaces it
+            if self.pool is pool:
+                logger.error("a render worker died, starting a new pool")
+                pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = self.new_pool()
+            return 503, "the render worker died, try again", None
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+        timing.merge(spans)
+        encoders.merge(encoded)
+        if error:
+            return status, error, None
+        entry = (body, CONTENT_TYPES[fmt])
+        self.cache.put(key, *entry)
+        return status, None, entry
+
+    def metrics(self):
+        latencies = list(self.latencies)
+        return {
+            'uptime_s': round(time.monotonic() - self.started, 1),
+            'workers': self.workers,
+            'max_in_flight': self.max_in_flight,
+            'queue_depth': self.waiting,
+            'in_flight': self.in_flight,
+            'responses': {str(status): count for status, count in sorted(self.responses.items())},
+            'cache': self.cache.stats(),
+            'latency_ms': {
+                'count': len(latencies),
+                'p50': round(timing.percentile(latencies, 50), 2) if latencies else None,
+                'p95': round(timing.percentile(latencies, 95), 2) if latencies else None,
+                'p99': round(timing.percentile(latencies, 99), 2) if latencies else None,
+            },
+            'encoders': encoders.summary(),
+            'spans': timing.summary() if timing.enabled else None,
+        }
+
+    async def handle(self, method, target, headers, body):
+        """(status, content type, body, extra headers) of one request."""
+        url = urlsplit(target)
+        if url.path == '/render':
+            if method != 'POST':
+                raise HTTPError(405, "POST an image or JSON to /render")
+            source, config = self.parse_render(parse_qsl(url.query), headers, body)
+            try:
+                (data, content_type), cache = await self.render(source, config)
+            except asyncio.TimeoutError:
+                raise HTTPError(504, f"render took longer than {self.timeout}s")
+            return 200, content_type, data, {'X-Cache': cache}
+        if url.path == '/metrics':
+            if method != 'GET':
+                raise HTTPError(405, "GET /metrics")
+            return 200, 'application/json', json.dumps(self.metrics(), indent=2).encode('utf-8'), {}
+        raise HTTPError(404, f"no such endpoint: {url.path}")
+
+    async def read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(400, "bad request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            raise HTTPError(411, "send a Content-Length, chunked bodies are not supported")
+        try:
+            length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HTTPError(400, "bad Content-Length")
+        if length > self.max_body:
+            raise HTTPError(413, f"body larger than {self.max_body // (1024 * 1024)}MB")
+        body = await reader.readexactly(length) if length else b''
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+        return method, target, headers, body, keep_alive
+
+    async def serve_client(self, reader, writer):
+        try:
+            while True:
+                start = time.perf_counter()
+                extra = {}
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        break
+                    method, target, headers, body, keep_alive = request
+                    status, content_type, data, extra = await self.handle(method, target, headers, body)
+                except HTTPError as e:
+                    # the body may be left unread, do not reuse the connection
+                    status, content_type, keep_alive = e.status, 'application/json', False
+                    data = json.dumps({'error': str(e)}).encode('utf-8')
+                except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                    raise
+                except Exception as e:
+                    # a bug, not the client's fault; it still gets a status line
+                    logger.exception(f"{type(e).__name__} while serving a request")
+                    status, content_type, keep_alive = 500, 'application/json', False
+                    data = json.dumps({'error': f"{type(e).__name__}: {e}"}).encode('utf-8')
+                self.responses[status] = self.responses.get(status, 0) + 1
+                if status == 200 and content_type != 'application/json':
+                    self.latencies.append((time.perf_counter() - start) * 1e3)
+                head = [f"HTTP/1.1 {status} {STATUS[status]}", f"Content-Type: {content_type}",
+                        f"Content-Length: {len(data)}", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+                head += [f"{name}: {value}" for name, value in extra.items()]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # ValueError: a header line longer than the stream limit
+            pass
+        finally:
+            writer.close()
+
+    def new_pool(self):
+        # spawn, like the batch pool; workers warm the icons and the fonts of a 24MP 3:2 frame
+        ctx = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx, initializer=init_daemon_worker,
+                                   initargs=(self.config, [(6000, 4000)], timing.enabled))
+
+    async def serve(self, host, port):
+        self.pool = self.new_pool()
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+        try:
+            server = await asyncio.start_server(self.serve_client, host, port)
+            logger.info(f"serving on http://{host}:{port} with {self.workers} workers, {self.max_in_flight} in flight")
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve watermark renders over HTTP on this machine")
+    parser.add_argument("-c", "--config", default=str(CONFIG_PATH), help="config yaml")
+    parser.add_argument("--host", default=None, help="address to bind (default: config service.host)")
+    parser.add_argument("--port", type=int, default=None, help="port (default: config service.port)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: config batch.workers, 0 = all cores)")
+    parser.add_argument("--timings", action="store_true", help="record stage timings, reported by /metrics")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    allow_large_images()
+    config = load_config(args.config)
+    service_config = config['service']
+    timing.enable(args.timings)
+    workers = args.workers if args.workers is not None else config['batch']['workers']
+    service = RenderService(config, workers, config['batch']['max_in_flight'], service_config['max_queue'],
+                            service_config['timeout'], service_config['cache_mb'], service_config['max_body_mb'])
+    try:
+        asyncio.run(service.serve(args.host or service_config['host'], args.port or service_config['port']))
+    except KeyboardInterrupt:
+        logger.info("stopped")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
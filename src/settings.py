@@ -0,0 +1,130 @@
+import os
+from pathlib import Path
+import ezkfg as ez
+
+FONTS_PATH = Path(__file__).parent / "asset" / "fonts"
+ICONS_PATH = Path(__file__).parent / "asset" / "icons"
+TEMP_PATH = Path(__file__).parent / "temp"
+CONFIG_PATH = Path(__file__).parent / "asset" / "config.yaml"
+
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg')
+PREVIEW_SIZE = 500
+THUMB_SIZE = 100
+
+CONFIG_TEMPLATE = {
+    'folder_history': [],
+    'max_folder_history': 10,
+    'thumb_cache_mb': 256,
+    # sources above this many megapixels are rendered on a disk backed canvas
+    # with bounded memory, 0: never. Only RGB JPEG and PNG files,
+    # which are decoded straight into the canvas; RGBA, palette and other
+    # sources are always decoded and pasted in memory
+    'stream_above_mp': 150,
+    'batch': {
+        # 0: one worker per core / two queued jobs per worker
+        'workers': 0,
+        'max_in_flight': 0,
+        # --pipeline: threads encoding exports, apart from the compositing ones
+        'encode_threads': 2,
+    },
+    'service': {
+        # service.py: local HTTP render endpoint, workers come from `batch`
+        'host': '127.0.0.1',
+        'port': 8765,
+        'max_queue': 64,
+        'timeout': 30,
+        'cache_mb': 256,
+        'max_body_mb': 200,
+        # decoded size limit of uploaded images, 0: none; paths are trusted
+        'max_upload_mp': 200,
+    },
+    'output': {
+        # source: same format as the input; jpeg, webp, png, or preview (small, fast jpeg)
+        'format': 'source',
+        'keep_exif': True,
+        'keep_icc': True,
+        'jpeg': {'quality': 75, 'subsampling': '4:2:0', 'optimize': False, 'progressive': False},
+        'webp': {'quality': 80, 'method': 4, 'lossless': False},
+        'png': {'compress_level': 6},
+        'preview': {'quality': 80},
+    },
+    'watermark': {
+        'text': 'LEICA',
+        'font': {
+            'bold': str(FONTS_PATH / "SourceHanSansCN-Bold.otf"),
+            'light': str(FONTS_PATH / "SourceHanSansCN-Light.otf"),
+        },
+        'font_size': "20%",
+        'font_color': [0, 0, 0, 255],
+        'border': {
+            "size": "3%",
+            "ratio": "auto",
+        },
+        'bg_color': [255, 255, 255, 255],
+        'text_area': {
+            'height': "15%",
+            'width': "100%",
+        },
+        'margin': '3%',
+        'div_line_width': 10,
+        'div_line_color': [156, 156, 156, 255],
+    },
+    'show_info': {
+        'camera': True,
+        'camera_maker': True,
+        'lens': True,
+        'focal_length': True,
+        'aperture': True,
+        'shutter_speed': True,
+        'iso': True,
+        'date': True,
+        'time': True,
+        'gps': False,
+    },
+    'icons': {
+        'canon': str(ICONS_PATH / "canon.png"),
+        'leica': str(ICONS_PATH / "leica.png"),
+        'nikon': str(ICONS_PATH / "nikon.png"),
+        'sony': str(ICONS_PATH / "sony.png"),
+        'olympus': str(ICONS_PATH / "olympus.png"),
+        'panasonic': str(ICONS_PATH / "panasonic.png"),
+        'fujifilm': str(ICONS_PATH / "fujifilm.png"),
+        'apple': str(ICONS_PATH / "apple.png"),
+        'xiaomi': str(ICONS_PATH / "xiaomi.png"),
+        'huawei': str(ICONS_PATH / "huawei.png"),
+    }
+}
+
+
+def allow_large_images():
+    # Sources are the user's own panoramas and scans: lift Pillow's decompression
+    # bomb guard, which refuses anything above ~179MP. Called by the entry points
+    # and by pool workers, which start in fresh interpreters; images from other
+    # people, like service uploads, are checked against a limit of their own.
+    from PIL import Image
+    Image.MAX_IMAGE_PIXELS = None
+
+
+def load_config(config_path=CONFIG_PATH):
+    # user config merged over the template, nothing is written back
+    config = ez.Config(CONFIG_TEMPLATE)
+    try:
+        config.update(ez.load(config_path))
+    except Exception:
+        pass
+    return config
+
+
+def save_config(config, config_path=CONFIG_PATH):
+    # leave the file alone when it already holds this config; returns whether it wrote
+    try:
+        if ez.load(config_path).dict() == config.dict():
+            return False
+    except Exception:
+        pass
+    # atomic: a crash mid-write leaves the previous file, never half a yaml
+    config_path = Path(config_path)
+    tmp = config_path.with_name(f".{config_path.stem}.tmp{config_path.suffix}")
+    config.dump(tmp)
+    os.replace(tmp, config_path)
+    return True
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import threading
+from PIL import Image
+from settings import TEMP_PATH, THUMB_SIZE
+from proxy import open_proxy
+
+THUMB_CACHE_PATH = TEMP_PATH / "thumbs"
+
+
+class ThumbCache:
+    """On-disk thumbnail cache, shared by every folder.
+
+    Entries are named by a hash of (path, mtime, size, thumbnail size), so an
+    edited file simply misses. Hits touch the entry's mtime and eviction drops
+    the least recently used entries once the cache grows past max_bytes.
+    """
+
+    def __init__(self, root=THUMB_CACHE_PATH, max_bytes=256 * 1024 * 1024, size=THUMB_SIZE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = size
+        self.lock = threading.Lock()
+        self.total_bytes = None
+
+    def key(self, img_path):
+        st = os.stat(img_path)
+        ident = f"{os.path.abspath(img_path)}\0{st.st_mtime_ns}\0{st.st_size}\0{self.size}"
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key[:2], key + ".jpg")
+
+    def get(self, img_path):
+        path = self.entry_path(self.key(img_path))
+        try:
+            thumb = Image.open(path)
+            thumb.load()
+            os.utime(path)
+            return thumb
+        except (OSError, ValueError):
+            pass
+
+        thumb, _ = open_proxy(img_path, self.size)
+        thumb = thumb.convert('RGB')
+        self.put(path, thumb)
+        return thumb
+
+    def put(self, path, thumb):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        thumb.save(tmp, 'JPEG', quality=85)
+        os.replace(tmp, path)
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.entries())
+            else:
+                self.total_bytes += os.path.getsize(path)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".jpg"):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, st.st_size, st.st_mtime
+
+    def evict(self):
+        # down to 90% so a full cache does not walk the tree on every insert
+        target = self.max_bytes * 0.9
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes -= size
+            except OSError:
+                pass
@@ -0,0 +1,99 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# Opt-in span timing for the render path. Disabled, `span()` hands back one
+# shared no-op context manager, so an instrumented call costs a global lookup.
+# Enabled, every span appends one tuple to a process-wide list:
+#   (name, pid, thread name, thread id, start ns, duration ns)
+# Worker processes `drain()` their spans and the parent `merge()`s them, the
+# result can be written as per-span aggregates or as a Chrome trace.
+#   with timing.span('decode'):
+#       ...
+
+enabled = False
+events = []
+NULL = nullcontext()
+
+
+class Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter_ns() - self.start
+        thread = threading.current_thread()
+        # list.append is atomic, no lock needed between render threads
+        events.append((self.name, os.getpid(), thread.name, thread.ident, self.start, duration))
+        return False
+
+
+def span(name):
+    return Span(name) if enabled else NULL
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def drain():
+    # hand the spans recorded so far to the caller, e.g. back to the parent process
+    global events
+    drained, events = events, []
+    return drained
+
+
+def merge(spans):
+    events.extend(spans)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summary(spans=None):
+    """Aggregate spans per name: count, total, mean, p50, p95 and max in ms."""
+    durations = {}
+    for name, _, _, _, _, duration in events if spans is None else spans:
+        durations.setdefault(name, []).append(duration / 1e6)
+    return {
+        name: {
+            'count': len(values),
+            'total_ms': round(sum(values), 3),
+            'mean_ms': round(sum(values) / len(values), 3),
+            'p50_ms': round(percentile(values, 50), 3),
+            'p95_ms': round(percentile(values, 95), 3),
+            'max_ms': round(max(values), 3),
+        }
+        for name, values in sorted(durations.items())
+    }
+
+
+def chrome_trace(spans=None):
+    # Trace Event Format, loads in chrome://tracing and Perfetto
+    spans = events if spans is None else spans
+    trace = []
+    threads = {}
+    for name, pid, thread_name, tid, start, duration in spans:
+        threads[(pid, tid)] = thread_name
+        trace.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': start / 1e3, 'dur': duration / 1e3})
+    for (pid, tid), thread_name in threads.items():
+        trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+
+def write_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
@@ -0,0 +1,391 @@
+import argparse
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import select
+import struct
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from loguru import logger
+from settings import CONFIG_PATH, IMAGE_SUFFIXES, allow_large_images, load_config
+from batch import init_daemon_worker, plain_config, render_job, resolve_workers
+from manifest import ExportManifest
+import encoders
+import timing
+
+# Watch-folder daemon: exports every image that lands in the watched folders
+# into their `export` folder, the one the GUI uses, until interrupted.
+#   python watch.py ~/Tether -c config.yaml
+# Files are picked up through inotify where available, by polling otherwise,
+# and only once they stopped changing and look complete. At most
+# `batch.max_in_flight` images are in the pool; the rest wait as paths.
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+EVENT = struct.Struct('iIII')
+
+
+def is_candidate(path):
+    name = os.path.basename(path)
+    return name.lower().endswith(IMAGE_SUFFIXES) and not name.startswith('.')
+
+
+def walk(folder, recursive=True):
+    # every image below folder, never inside an export folder
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if d != "export" and not d.startswith('.')] if recursive else []
+        for name in files:
+            path = os.path.join(root, name)
+            if is_candidate(path):
+                yield path
+
+
+def export_target(folder, path):
+    # mirrors cli.collect_jobs: <folder>/export/<sub folders>/<name>
+    rel = os.path.relpath(os.path.dirname(path), folder)
+    return os.path.normpath(os.path.join(folder, "export", rel, os.path.basename(path)))
+
+
+class InotifyWatcher:
+    """Linux inotify through libc, no extra dependency."""
+
+    def __init__(self, folders, recursive=True):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.recursive = recursive
+        self.dirs = {}
+        for folder in folders:
+            self.add_tree(folder)
+
+    def add(self, folder):
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"cannot watch {folder}")
+        self.dirs[wd] = folder
+
+    def add_tree(self, folder):
+        self.add(folder)
+        if self.recursive:
+            for root, dirs, _ in os.walk(folder):
+                dirs[:] = [d for d in dirs if d != "export" and not d.startswith('.')]
+                for d in dirs:
+                    self.add(os.path.join(root, d))
+
+    def poll(self, timeout):
+        """Paths that changed, waiting up to timeout seconds for the first one."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        paths = []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return paths
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0'))
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, look at everything again
+                for folder in set(self.dirs.values()):
+                    paths.extend(walk(folder, recursive=False))
+                continue
+            folder = self.dirs.get(wd)
+            if folder is None:
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and self.recursive and name != "export" and not name.startswith('.'):
+                    # a new sub folder may already hold files by now
+                    self.add_tree(path)
+                    paths.extend(walk(path))
+            elif is_candidate(path):
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback for non-Linux systems and network shares inotify cannot see."""
+
+    def __init__(self, folders, recursive=True, interval=0.5):
+        self.folders = folders
+        self.recursive = recursive
+        self.interval = interval
+        self.seen = {}
+        self.next_scan = 0.0
+
+    def poll(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        self.next_scan = time.monotonic() + self.interval
+        paths = []
+        for folder in self.folders:
+            for path in walk(folder, self.recursive):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if self.seen.get(path) != (st.st_size, st.st_mtime_ns):
+                    self.seen[path] = (st.st_size, st.st_mtime_ns)
+                    paths.append(path)
+        return paths
+
+    def close(self):
+        pass
+
+
+def looks_complete(path):
+    # tethering tools write in pieces; a JPEG is whole once it ends with EOI
+    # (some cameras pad after it), a PNG once it ends with its IEND chunk
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 64, 0))
+            tail = f.read()
+    except OSError:
+        return False
+    if path.lower().endswith('.png'):
+        return b'IEND' in tail
+    return b'\xff\xd9' in tail
+
+
+class Settler:
+    """Debounce: a path is ready once its size and mtime held still for `settle` seconds.
+
+    An image that never looks complete is let through after `give_up`
+    seconds without a change, the render reports whatever is wrong with it.
+    """
+
+    def __init__(self, settle=0.25, give_up=10.0):
+        self.settle = settle
+        self.give_up = give_up
+        # path -> (size, mtime_ns, last change, first seen)
+        self.files = {}
+
+    def touch(self, path, now):
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.files.pop(path, None)
+            return
+        stamp = (st.st_size, st.st_mtime_ns)
+        entry = self.files.get(path)
+        if entry is None or entry[:2] != stamp:
+            self.files[path] = stamp + (now, entry[3] if entry else now)
+
+    def ready(self, now):
+        done = []
+        for path, (size, mtime_ns, changed, seen) in list(self.files.items()):
+            if now - changed < self.settle:
+                continue
+            self.touch(path, now)
+            entry = self.files.get(path)
+            if entry is None or entry[2] != changed:
+                continue
+            if looks_complete(path) or now - changed >= self.give_up:
+                done.append((path, seen))
+                del self.files[path]
+        return done
+
+
+class WatchService:
+    def __init__(self, folders, config, workers=0, max_in_flight=0, recursive=True, polling=False, settle=0.25):
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.config = plain_config(config)
+        self.workers, self.max_in_flight = resolve_workers(workers, max_in_flight)
+        self.recursive = recursive
+        self.polling = polling
+        self.settler = Settler(settle)
+        self.manifest = ExportManifest(self.config)
+        # paths waiting for a free slot, with the time they were first seen
+        self.backlog = deque()
+        self.queued = set()
+        # queued paths that changed again meanwhile, they go back to the settler once rendered
+        self.dirty = set()
+        # future -> (src, dst, seen)
+        self.in_flight = {}
+        # path -> times a worker died while it was in flight
+        self.crashes = {}
+        self.pool = None
+        self.latencies = deque(maxlen=256)
+        self.exported = 0
+        self.failed = 0
+
+    def watcher(self):
+        if not self.polling and sys.platform.startswith('linux'):
+            try:
+                return InotifyWatcher(self.folders, self.recursive)
+            except OSError as e:
+                logger.warning(f"inotify unavailable ({e}), polling instead")
+        return PollingWatcher(self.folders, self.recursive)
+
+    def enqueue(self, path, seen):
+        if path in self.queued:
+            self.dirty.add(path)
+            return
+        folder = next(folder for folder in self.folders if path.startswith(folder + os.sep))
+        dst = encoders.output_path(export_target(folder, path), self.config['output'])
+        # already exported with this config, e.g. before a restart
+        if not self.manifest.pending([(path, dst)]):
+            return
+        self.backlog.append((path, dst, seen))
+        self.queued.add(path)
+
+    def new_pool(self):
+        ctx = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx, initializer=init_daemon_worker,
+                                   initargs=(self.config, (), timing.enabled))
+
+    def restart_pool(self):
+        logger.error("a render worker died, restarting the pool")
+        # every future of a broken pool is settled once it is shut down
+        self.pool.shutdown(wait=True)
+        self.collect()
+        self.pool = self.new_pool()
+
+    def submit(self):
+        while self.backlog and len(self.in_flight) < self.max_in_flight:
+            src, dst, seen = self.backlog.popleft()
+            try:
+                future = self.pool.submit(render_job, src, dst, self.config)
+            except BrokenProcessPool:
+                # a worker died while the pool was idle
+                self.backlog.appendleft((src, dst, seen))
+                self.restart_pool()
+                continue
+            self.in_flight[future] = (src, dst, seen)
+
+    def release(self, src):
+        self.queued.discard(src)
+        if src in self.dirty:
+            # overwritten while it was rendered; the manifest drops it again
+            # if the version rendered was the last one after all
+            self.dirty.discard(src)
+            self.settler.touch(src, time.monotonic())
+
+    def crashed(self, src, dst, seen):
+        # the worker died under one of the images in flight, e.g. OOM-killed,
+        # and took all of them along; each is tried once more, an image the
+        # pool dies under twice counts as failed
+        self.crashes[src] = self.crashes.get(src, 0) + 1
+        if self.crashes[src] == 1:
+            self.backlog.appendleft((src, dst, seen))
+            return
+        del self.crashes[src]
+        self.release(src)
+        self.failed += 1
+        logger.error(f"{src}: the render worker died")
+
+    def collect(self):
+        """Handle the finished futures, True if the pool broke."""
+        broken = False
+        for future in [future for future in self.in_flight if future.done()]:
+            src, dst, seen = self.in_flight.pop(future)
+            try:
+                src, dst, error, (spans, encoded) = future.result()
+            except BrokenProcessPool:
+                broken = True
+                self.crashed(src, dst, seen)
+                continue
+            timing.merge(spans)
+            encoders.merge(encoded)
+            self.crashes.pop(src, None)
+            self.release(src)
+            if error:
+                self.failed += 1
+                logger.error(f"{src}: {error}")
+                continue
+            self.exported += 1
+            self.manifest.record(src, dst)
+            latency = time.monotonic() - seen
+            self.latencies.append(latency)
+            logger.info(f"{os.path.basename(src)} -> {dst} in {latency:.2f}s")
+        return broken
+
+    def report(self):
+        if self.latencies:
+            latencies = list(self.latencies)
+            logger.info(f"{self.exported} exported, {self.failed} failed, {len(self.backlog)} waiting, "
+                        f"latency p50 {timing.percentile(latencies, 50):.2f}s p95 {timing.percentile(latencies, 95):.2f}s")
+
+    def run(self, tick=0.05, report_every=30.0):
+        watcher = self.watcher()
+        logger.info(f"watching {', '.join(self.folders)} with {type(watcher).__name__}, {self.workers} workers, {self.max_in_flight} in flight")
+        next_report = time.monotonic() + report_every
+        next_warning = 0.0
+        try:
+            self.pool = self.new_pool()
+            # whatever arrived while the daemon was down, settled like new
+            # files since a copy may still be running
+            now = time.monotonic()
+            for folder in self.folders:
+                for path in walk(folder, self.recursive):
+                    self.settler.touch(path, now)
+            while True:
+                for path in watcher.poll(tick):
+                    self.settler.touch(path, time.monotonic())
+                for path, seen in self.settler.ready(time.monotonic()):
+                    self.enqueue(path, seen)
+                if self.collect():
+                    self.restart_pool()
+                self.submit()
+                if len(self.backlog) > self.max_in_flight * 4 and time.monotonic() >= next_warning:
+                    logger.warning(f"ingest is ahead of rendering, {len(self.backlog)} images waiting")
+                    next_warning = time.monotonic() + 10.0
+                if time.monotonic() >= next_report:
+                    self.report()
+                    next_report = time.monotonic() + report_every
+        except KeyboardInterrupt:
+            logger.info("stopping, finishing the images in flight")
+            wait(list(self.in_flight))
+            self.collect()
+        finally:
+            if self.pool:
+                self.pool.shutdown()
+            watcher.close()
+            self.manifest.flush()
+            self.report()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Watch folders and watermark every new image into <folder>/export")
+    parser.add_argument("folders", nargs="+", help="folders to watch")
+    parser.add_argument("-c", "--config", default=str(CONFIG_PATH), help="config yaml")
+    parser.add_argument("--no-recursive", action="store_true", help="do not watch sub folders")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: config batch.workers, 0 = all cores)")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="images in the pool at once (default: 2 per worker)")
+    parser.add_argument("--polling", action="store_true", help="poll instead of inotify, e.g. for network shares")
+    parser.add_argument("--settle", type=float, default=0.25, help="seconds a file must stay unchanged before it is picked up")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    allow_large_images()
+    config = load_config(args.config)
+    workers = args.workers if args.workers is not None else config['batch']['workers']
+    max_in_flight = args.max_in_flight if args.max_in_flight is not None else config['batch']['max_in_flight']
+    WatchService(args.folders, config, workers, max_in_flight, recursive=not args.no_recursive,
+                 polling=args.polling, settle=args.settle).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,440 @@
+import json
+import os
+from collections import namedtuple
+from functools import lru_cache
+from PIL import Image, ImageDraw
+from loguru import logger
+from settings import PREVIEW_SIZE
+from exif import cached_image_info
+from proxy import open_proxy
+from resources import load_font, load_icon, load_icon_source
+from timing import span
+from diskcanvas import attach, trim, trimming
+import encoders
+
+# Qt-free rendering: every function takes the config it needs and the layout
+# is an immutable plan, so renders can run headless and in parallel.
+# Reduced proxies are laid out as their full resolution original, then scaled.
+
+# everything about the frame that only depends on geometry and the watermark config
+LayoutPlan = namedtuple('LayoutPlan', [
+    'composition',  # True: landscape, False: portrait
+    'border_ratio',
+    'border_size',
+    'text_area_size',
+    'nwidth',
+    'nheight',
+    'font_size',
+    'margin',
+    'div_line_width',
+])
+
+
+def get_percent(value, total):
+    value = int(value.split('%')[0])
+    return int(1.0*value*total/100)
+
+
+def deal_height_weight_type(value, img_size):
+    if type(value) == int:
+        return (value, value)
+    elif (type(value) == list or type(value) == tuple) and len(value) == 2:
+        value = list(value)
+        if '%' in value[0]:
+            value[0] = get_percent(value[0], img_size[0])
+        if '%' in value[1]:
+            value[1] = get_percent(value[1], img_size[1])
+        return (value[0], value[1])
+    elif type(value) == str and '%' in value:
+        value = value.split('%')[0]
+        return (get_percent(value, img_size[0]), get_percent(value, img_size[1]))
+
+
+def get_icon_path(config, camera_maker):
+    for key, value in config['icons'].items():
+        if key.lower() in camera_maker.lower():
+            return value
+    return config['icons']['leica']
+
+
+def text_size(draw, text, font):
+    # ImageDraw.textsize was removed in Pillow 10
+    if hasattr(draw, 'textsize'):
+        return draw.textsize(text, font)
+    bbox = draw.textbbox((0, 0), text, font)
+    return (bbox[2], bbox[3])
+
+
+def get_layout(img_size, wm_config, scale=1.0):
+    # a shoot has only a handful of geometries, plans are memoized per
+    # (size, watermark config, scale)
+    with span('layout'):
+        if hasattr(wm_config, 'dict'):
+            wm_config = wm_config.dict()
+        return plan_layout(tuple(img_size), json.dumps(wm_config, sort_keys=True), scale)
+
+
+@lru_cache(maxsize=64)
+def plan_layout(img_size, wm_key, scale):
+    # layout of a full resolution image; proxies pass scale < 1 so every pixel
+    # value, including the absolute ones from the config, shrinks the same way
+    wm_config = json.loads(wm_key)
+    composition = img_size[0] > img_size[1]
+
+    # border
+    border_size = wm_config['border']['size']
+    border_size = deal_height_weight_type(border_size, img_size)
+
+    if ":" in wm_config['border']['ratio']:
+        border_ratio = wm_config['border']['ratio'].split(':')
+        if int(border_ratio[0]) < int(border_ratio[1]):
+            border_ratio = int(border_ratio[1]) / int(border_ratio[0])
+        else:
+            border_ratio = int(border_ratio[0]) / int(border_ratio[1])
+    else:
+        border_ratio = None
+
+
+    # text area size
+    text_area_size = wm_config['text_area']['width'], wm_config['text_area']['height']
+    text_area_size = deal_height_weight_type(text_area_size, img_size)
+
+    # new image size
+    # always bottom
+    nheight = img_size[1] + text_area_size[1] + border_size[1]
+    nwidth = nheight * border_ratio if border_ratio else img_size[0] + border_size[0] * 2
+
+    nheight = int(nheight)
+    nwidth = int(nwidth)
+
+    # font
+    font_size = wm_config['font_size']
+    if type(font_size) == str and '%' in font_size:
+        font_size = get_percent(font_size, text_area_size[1])
+
+    font_size = int(min(font_size, text_area_size[0] / 30))
+
+    margin = get_percent(wm_config['margin'], text_area_size[0]) if '%' in str(wm_config['margin']) else wm_config['margin']
+
+    div_line_width = get_percent(wm_config['div_line_width'], text_area_size[0]) if '%' in str(wm_config['div_line_width']) else int(wm_config['div_line_width'])
+    div_line_width = min(div_line_width, 20, int(nwidth / 500))
+
+    plan = LayoutPlan(composition, border_ratio, border_size, text_area_size, nwidth, nheight,
+                      font_size, margin, div_line_width)
+    logger.debug("layout for {} at scale {}: {}", img_size, scale, plan)
+    if scale == 1.0:
+        return plan
+    return LayoutPlan(
+        composition,
+        border_ratio,
+        border_size=(int(border_size[0] * scale), int(border_size[1] * scale)),
+        text_area_size=(int(text_area_size[0] * scale), int(text_area_size[1] * scale)),
+        nwidth=int(nwidth * scale),
+        nheight=int(nheight * scale),
+        font_size=max(int(font_size * scale), 1),
+        margin=int(margin * scale),
+        div_line_width=max(int(div_line_width * scale), 1),
+    )
+
+
+def get_fonts(wm_config, font_size):
+    return {
+        'bold': load_font(wm_config['font']['bold'], font_size),
+        'light': load_font(wm_config['font']['light'], max(int(font_size * 0.8), 1)),
+    }
+
+
+def get_icon_height(layout):
+    return layout.font_size * 2 if layout.composition else layout.font_size
+
+
+def warm_resources(config, img_sizes=()):
+    # pool initializer: open fonts and icons before the first job arrives
+    for icon_path in config['icons'].values():
+        try:
+            load_icon_source(str(icon_path))
+        except OSError:
+            pass
+    for img_size in img_sizes:
+        layout = get_layout(img_size, config['watermark'])
+        try:
+            get_fonts(config['watermark'], layout.font_size)
+        except OSError:
+            # a missing font is reported by the job itself
+            pass
+        for icon_path in config['icons'].values():
+            try:
+                load_icon(str(icon_path), get_icon_height(layout))
+            except OSError:
+                pass
+
+
+def rgb(color):
+    # the canvas is RGB; config colors carry an alpha byte that was always dropped on export
+    return tuple(color[:3])
+
+
+def photo_box(layout, img_size):
+    x = int((layout.nwidth-img_size[0])/2)
+    y = layout.border_size[1]
+    return (x, y, x + img_size[0], y + img_size[1])
+
+
+def fill_border(canvas, box, color, band=256):
+    width, height = canvas.size
+    for region in ((0, 0, width, box[1]), (0, box[3], width, height), (0, box[1], box[0], box[3]), (box[2], box[1], width, box[3])):
+        # in bands of rows, a disk mapped canvas drops each one once it is painted
+        for top in range(region[1], region[3], band):
+            if region[2] > region[0]:
+                canvas.paste(color, (region[0], top, region[2], min(top + band, region[3])))
+                trim(canvas)
+
+
+def open_canvas(img_path, config):
+    """Decode img_path straight into its place on the watermark canvas.
+
+    For single-tile RGB JPEG/PNG files the decoder writes into the photo region
+    of the full canvas, so a render holds one frame (the canvas, 4 bytes per
+    pixel in Pillow) instead of source + RGBA copy + canvas + RGB copy. Other
+    files are decoded and pasted, two frames at the peak.
+
+    Above `stream_above_mp` that one frame is a disk mapped canvas and only
+    the rows being decoded stay resident, see diskcanvas.
+    """
+    wm_config = config['watermark']
+    img = Image.open(img_path)
+    layout = get_layout(img.size, wm_config)
+    box = photo_box(layout, img.size)
+    size = (layout.nwidth, layout.nheight)
+    tile = img.tile[0] if len(img.tile) == 1 else None
+    if (img.mode == 'RGB' and tile and tile[0] in ('jpeg', 'zip') and tuple(tile[1]) == (0, 0) + img.size
+            and box[0] >= 0 and box[2] <= size[0] and box[3] <= size[1]):
+        try:
+            return decode_into(img, tile, box, size, config), layout
+        except (AttributeError, TypeError, ValueError, SystemError) as e:
+            # tile and _size are Pillow internals (tested with 12.x); should
+            # they change, decode and paste like any other file
+            logger.warning(f"decoding into the canvas failed ({type(e).__name__}: {e}), pasting instead")
+            if hasattr(img_path, 'seek'):
+                img_path.seek(0)
+            img = Image.open(img_path)
+    canvas = Image.new('RGB', size, rgb(wm_config['bg_color']))
+    canvas.paste(img, box[:2])
+    # decoded into place, the source keeps its metadata; carry it over for the
+    # encoder. The pixels of a CMYK, grey or palette source are RGB now, its
+    # profile no longer describes them
+    keys = ('exif', 'icc_profile') if img.mode == 'RGB' else ('exif',)
+    canvas.info.update({key: img.info[key] for key in keys if key in img.info})
+    return canvas, layout
+
+
+def decode_into(img, tile, box, size, config):
+    # point the single decoder tile at the photo region of a canvas-sized image
+    img.tile = [(tile[0], box) + tuple(tile[2:])]
+    img._size = size
+    if config['stream_above_mp'] and size[0] * size[1] > config['stream_above_mp'] * 1e6:
+        attach(img, size)
+    with trimming(img):
+        img.load()
+        # the side borders touch every row
+        fill_border(img, box, rgb(config['watermark']['bg_color']))
+    return img
+
+
+def add_watermark(img, info_dict, config, full_size=None):
+    # full_size: resolution of the original when img is a reduced proxy
+    wm_config = config['watermark']
+    full_size = full_size or img.size
+    layout = get_layout(full_size, wm_config, img.size[0] / full_size[0])
+
+    nimg = Image.new('RGB', (layout.nwidth, layout.nheight), rgb(wm_config['bg_color']))
+    nimg.paste(img, photo_box(layout, img.size)[:2])
+    return draw_strip(nimg, info_dict, layout, config)
+
+
+def redraw_strip(watermarked, img_size, info_dict, config, full_size=None):
+    # repaint only the text area below the photo, on a copy of an earlier
+    # add_watermark result; valid while nothing but show_info has changed
+    wm_config = config['watermark']
+    full_size = full_size or img_size
+    layout = get_layout(full_size, wm_config, img_size[0] / full_size[0])
+    nimg = watermarked.copy()
+    nimg.paste(rgb(wm_config['bg_color']), (0, photo_box(layout, img_size)[3], layout.nwidth, layout.nheight))
+    return draw_strip(nimg, info_dict, layout, config)
+
+
+def draw_strip(nimg, info_dict, layout, config):
+    # text, icon and divider of the bottom text area
+    font = get_fonts(config['watermark'], layout.font_size)
+
+    with span('text'):
+        draw_camera_text(nimg, info_dict, font, layout, config)
+        start_pos_width, start_pos_width_dt = draw_detail_text(nimg, info_dict, font, layout, config)
+
+    icon_path = get_icon_path(config, info_dict['camera_maker'])
+    if icon_path and config['show_info']['camera_maker']:
+        with span('icon'):
+            icon = load_icon(str(icon_path), get_icon_height(layout))
+            draw_icon(nimg, icon, layout, config, start_pos_width, start_pos_width_dt)
+
+    return nimg
+
+
+def draw_icon(img, icon, layout, config, start_pos_width, start_pos_width_dt):
+    wm_config = config['watermark']
+    text_area_size = layout.text_area_size
+    margin = layout.margin
+
+    if layout.composition:
+        div_line_width = layout.div_line_width
+        icon_pos = (int(start_pos_width - icon.size[0] - margin * 2 - div_line_width), int(layout.nheight-text_area_size[1] + (text_area_size[1]-icon.size[1])/2))
+        img.paste(icon, icon_pos, icon)
+
+        # draw div line
+        draw = ImageDraw.Draw(img)
+        line_x = start_pos_width - margin - div_line_width
+        draw.line((line_x, icon_pos[1], line_x, icon_pos[1] + icon.size[1]), fill=rgb(wm_config['div_line_color']), width=int(div_line_width))
+    else:
+        font_size = layout.font_size
+        icon_pos = (int(start_pos_width_dt - icon.size[0] - margin * 2), layout.nheight-text_area_size[1] + int(font_size / 0.8) + int((text_area_size[1]-2*font_size)/5 * 3 - font_size / 0.8 * 0.2))
+        img.paste(icon, icon_pos, icon)
+    return img
+
+
+def draw_camera_text(img, info, font, layout, config):
+    draw = ImageDraw.Draw(img)
+    font_color = rgb(config['watermark']['font_color'])
+    border_size = layout.border_size
+    text_area_size = layout.text_area_size
+    nheight = layout.nheight
+
+    if config['show_info']['camera']:
+        text = info['camera']
+        size = text_size(draw, text, font['bold'])
+        text_pos = (int(border_size[0]), nheight-text_area_size[1] + int((text_area_size[1]-2*size[1])/5*2))
+        draw.text(text_pos, text, font_color, font=font['bold'])
+
+    if config['show_info']['lens']:
+        text = info['lens']
+        size = text_size(draw, text, font['light'])
+        text_pos = (int(border_size[0]), nheight-text_area_size[1] + int(size[1] / 0.8) + int((text_area_size[1]-2*size[1])/5*3))
+        draw.text(text_pos, text, font_color, font=font['light'])
+    return img
+
+
+def detail_text(info, show_info):
+    text = ""
+    if show_info['focal_length']:
+        text += info['focal_length']
+    if show_info['aperture']:
+        text += ' ' + info['aperture']
+    if show_info['shutter_speed']:
+        text += ' ' + info['shutter_speed']
+    if show_info['iso']:
+        text += ' ' + info['iso']
+    return text
+
+
+def date_text(info, show_info):
+    text = ""
+    if show_info['date']:
+        text += info['date']
+    if show_info['time']:
+        text += ' ' + info['time']
+    return text
+
+
+def render_signature(info, config):
+    # everything that changes the pixels of one export; a show_info flag only
+    # matters through the strings it adds or removes
+    show_info = config['show_info']
+    wm_config = config['watermark']
+    icon_path = get_icon_path(config, info['camera_maker']) if show_info['camera_maker'] else None
+    return {
+        'watermark': wm_config.dict() if hasattr(wm_config, 'dict') else wm_config,
+        'camera': info['camera'] if show_info['camera'] else None,
+        'lens': info['lens'] if show_info['lens'] else None,
+        'detail': detail_text(info, show_info),
+        'date': date_text(info, show_info),
+        'icon': str(icon_path) if icon_path else None,
+    }
+
+
+def draw_detail_text(img, info, font, layout, config):
+    # returns the left edge of the detail block and of the date line, the icon
+    # is placed relative to them
+    draw = ImageDraw.Draw(img)
+    show_info = config['show_info']
+    font_color = rgb(config['watermark']['font_color'])
+    border_size = layout.border_size
+    text_area_size = layout.text_area_size
+    nheight = layout.nheight
+    nwidth = layout.nwidth
+
+    text = detail_text(info, show_info)
+    size = text_size(draw, text, font['bold'])
+    text_pos = (int(nwidth - border_size[0] - size[0]), nheight-text_area_size[1] + int((text_area_size[1]-2*size[1])/5*2))
+    draw.text(text_pos, text, font_color, font=font['bold'])
+
+    start_pos_width = text_pos[0]
+
+    text = date_text(info, show_info)
+    size = text_size(draw, text, font['light'])
+    text_pos = (int(nwidth - border_size[0] - size[0]), nheight-text_area_size[1] + int(size[1] / 0.8) + int((text_area_size[1]-2*size[1])/5*3))
+    draw.text(text_pos, text, font_color, font=font['light'])
+
+    return min(start_pos_width, text_pos[0]), text_pos[0]
+
+
+def export_path(img_path, export_folder, output=None):
+    path = os.path.join(export_folder, os.path.basename(img_path))
+    return encoders.output_path(path, output) if output else path
+
+
+def decode(img_path, config):
+    with span('exif'):
+        target_dict = cached_image_info(img_path)
+    with span('decode'):
+        canvas, layout = open_canvas(img_path, config)
+    return canvas, layout, target_dict
+
+
+def render(canvas, layout, target_dict, config):
+    with span('render'):
+        return draw_strip(canvas, target_dict, layout, config)
+
+
+def encode(watermarked, out_path, output):
+    with span('encode'), trimming(watermarked):
+        encoders.save(watermarked, out_path, output)
+    return out_path
+
+
+def process_single(img_path, config, out_path=None):
+    if out_path is None:
+        out_path = export_path(img_path, config['export_folder'], config['output'])
+    canvas, layout, target_dict = decode(img_path, config)
+    return encode(render(canvas, layout, target_dict, config), out_path, config['output'])
+
+
+def render_preview(img_path, config, size=PREVIEW_SIZE):
+    # watermark a working copy that already fits the preview label
+    # returns (source, watermarked), both about size x size
+    with span('exif'):
+        target_dict = cached_image_info(img_path)
+    with span('decode'):
+        img, full_size = open_proxy(img_path, size)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+    with span('render'):
+        return img, add_watermark(img, target_dict, config, full_size)
+
+
+def redraw_preview(img_path, img, watermarked, config):
+    # render_preview after a show_info change: same source, new text strip
+    with span('exif'):
+        target_dict = cached_image_info(img_path)
+    with span('render'):
+        with Image.open(img_path) as src:
+            full_size = src.size
+        return img, redraw_strip(watermarked, img.size, target_dict, config, full_size)